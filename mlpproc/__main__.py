@@ -4,15 +4,32 @@ and when run as main, executes the preprocessor using arguments from sys.argv
 """
 
 import argparse
+import json
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stderr, redirect_stdout
+from io import StringIO
+from multiprocessing import Manager
+from os import cpu_count, makedirs
 from os.path import abspath, dirname
 from pathlib import Path
 from sys import stderr, stdin, stdout
-from typing import List, Optional
+from typing import IO, Any, List, Optional, Set, Tuple, Union
 
+from .cache import CachedResult, DiskCache, ResultCache, hash_key
 from .defaults import Cmd_Def, Preprocessor
-from .defs import PREPROCESSOR_NAME, PREPROCESSOR_VERSION
+from .defs import PREPROCESSOR_NAME, PREPROCESSOR_VERSION, read_define_file
 from .errors import ErrorMode, WarningMode
+from .files import (
+    CACHE_MAXSIZE,
+    FileCache,
+    dependency_rule,
+    write_if_changed,
+    write_spliced,
+)
+from .memo import IncludeMemo
 from .preprocessor import Command
+from .watch import Watcher, make_watcher
 
 parser = argparse.ArgumentParser(prog=PREPROCESSOR_NAME, add_help=False)
 parser.add_argument("--begin", "-b", nargs="?", default=None)
@@ -24,12 +41,33 @@ parser.add_argument("--version", "-v", action="store_true")
 parser.add_argument("--output", "-o", nargs="?", type=Path, default=stdout)
 parser.add_argument("--help", "-h", nargs="?", const="", default=None)
 parser.add_argument("--define", "-d", "-D", nargs="?", action="append", default=[])
+parser.add_argument("--define-file", action="append", default=[])
 parser.add_argument(
     "--include", "-i", "-I", nargs=1, action="append", default=[], type=abspath
 )
 parser.add_argument("--silent", "-s", nargs=1, default=[], action="append")
+parser.add_argument("--include-once", action="store_true")
+parser.add_argument("--prefetch", action="store_true")
+parser.add_argument("--memoize-includes", action="store_true")
+parser.add_argument("--copy-verbatim", action="store_true")
 parser.add_argument("--recursion-depth", "-r", nargs=1, type=int)
-parser.add_argument("input", nargs="?", type=Path, default=stdin)
+parser.add_argument("--cache-dir", default=None, type=abspath)
+parser.add_argument("--cache-size", default=256, type=int)
+parser.add_argument("--cache-check", action="store_true")
+parser.add_argument("--cache-clean", action="store_true")
+parser.add_argument("--stream", action="store_true")
+parser.add_argument("--output-dir", "-O", default=None, type=Path)
+parser.add_argument("--files-from", default=None, type=Path)
+parser.add_argument("--jobs", "-j", default=1, type=int)
+parser.add_argument("--shared-includes", action="store_true")
+parser.add_argument("--watch", action="store_true")
+parser.add_argument("--write-if-changed", action="store_true")
+parser.add_argument("-M", dest="deps_only", action="store_true")
+parser.add_argument("-MF", dest="dep_file", default=None, type=Path)
+parser.add_argument("-MD", dest="dep_output", action="store_true")
+parser.add_argument("-MT", dest="dep_target", default=None)
+parser.add_argument("-MP", dest="dep_phony", action="store_true")
+parser.add_argument("input", nargs="*", type=Path)
 
 
 def process_defines(preproc: Preprocessor, defines: List[str]) -> None:
@@ -54,6 +92,24 @@ def process_defines(preproc: Preprocessor, defines: List[str]) -> None:
         Cmd_Def().define_macro(preproc, name, [], value)
 
 
+def process_define_files(preproc: Preprocessor, paths: List[str]) -> None:
+    """loads the defines of each file (see read_define_file) as constants,
+    the files are added to the dependencies"""
+    for path in paths:
+        try:
+            defines = read_define_file(path)
+        except OSError as error:
+            parser.error(
+                'argument --define-file: can\'t read "{}": {}'.format(
+                    path, error.strerror
+                )
+            )
+        except ValueError as error:
+            parser.error('argument --define-file: in "{}": {}'.format(path, error))
+        Cmd_Def.define_constants(preproc, defines)
+        preproc.add_dependency(path)
+
+
 def process_options(preproc: Preprocessor, arguments: argparse.Namespace) -> None:
     """process the preprocessor options
     see Preprocessor.get_help("") for a list and description of options"""
@@ -81,15 +137,26 @@ def process_options(preproc: Preprocessor, arguments: argparse.Namespace) -> Non
 
     preproc.commands["output_name"] = Cmd_Out()
 
-    # adding defined commands
+    # adding defined commands, -D overrides define files
+    process_define_files(preproc, arguments.define_file)
     process_defines(preproc, arguments.define)
 
-    # include path
-    preproc.include_path = [
+    # include path, without duplicates
+    preproc.include_path = []
+    for directory in [
         abspath(""),  # CWD
         dirname(abspath(input_name)),
         dirname(abspath(output_name)),
-    ] + arguments.include
+    ] + [include[0] for include in arguments.include]:
+        if directory not in preproc.include_path:
+            preproc.include_path.append(directory)
+
+    if arguments.include_once:
+        preproc.include_once = True
+    if arguments.prefetch:
+        preproc.prefetch_includes = True
+    if arguments.memoize_includes:
+        preproc.include_memo = IncludeMemo()
 
     # recursion depth
     if arguments.recursion_depth is not None:
@@ -116,6 +183,29 @@ def process_options(preproc: Preprocessor, arguments: argparse.Namespace) -> Non
     # silent warnings
     preproc.silent_warnings.extend([x[0] for x in arguments.silent])
 
+    # disk cache
+    if arguments.cache_dir is not None:
+        if arguments.cache_size < 0:
+            parser.error("argument --cache-size: size must be positive")
+        preproc.disk_cache = DiskCache(
+            arguments.cache_dir, arguments.cache_size * 1024 * 1024
+        )
+    elif arguments.cache_check or arguments.cache_clean:
+        parser.error("arguments --cache-check/--cache-clean require --cache-dir")
+    if preproc.disk_cache is not None:
+        if arguments.cache_clean:
+            removed = preproc.disk_cache.clean()
+            print("{}: removed {} cache entries".format(PREPROCESSOR_NAME, removed))
+            exit(0)
+        if arguments.cache_check:
+            stats = preproc.disk_cache.check()
+            print(
+                "{}: {} cache entries ({} bytes), removed {}".format(
+                    PREPROCESSOR_NAME, stats.entries, stats.size, stats.removed
+                )
+            )
+            exit(0)
+
     # version and help
     if arguments.version:
         print("{} version {}".format(PREPROCESSOR_NAME, PREPROCESSOR_VERSION))
@@ -125,25 +215,158 @@ def process_options(preproc: Preprocessor, arguments: argparse.Namespace) -> Non
         exit(0)
 
 
-def preprocessor_main(argv: Optional[List[str]] = None) -> None:
-    """main function for the preprocessor
-    handles arguments, reads contents from file
-    and write result to output file.
-    argv defaults to sys.argv
-    """
-    preprocessor = Preprocessor()
-    preprocessor.warning_mode = WarningMode.PRINT
-    preprocessor.error_mode = ErrorMode.PRINT_AND_EXIT
+def open_file(path: Path, mode: str, argument: str) -> IO[str]:
+    """opens path, exits with a parser error on failure"""
+    try:
+        return open(path, mode)
+    except FileNotFoundError:
+        parser.error(
+            'argument {}: no such file or directory "{}"'.format(argument, path)
+        )
+    except PermissionError:
+        parser.error('argument {}: permission denied "{}"'.format(argument, path))
 
-    if argv is None:
-        args = parser.parse_args()
+
+def write_file(
+    path: Path, text: Union[str, List[str]], argument: str, if_changed: bool
+) -> None:
+    """writes text to path, exits with a parser error on failure.
+    text can also be a list alternating text and files to copy, see write_spliced.
+    if if_changed, see write_if_changed"""
+    try:
+        if isinstance(text, list):
+            write_spliced(str(path), text)
+        elif if_changed:
+            write_if_changed(str(path), text)
+        else:
+            with open(path, "w") as file:
+                file.write(text)
+    except FileNotFoundError:
+        parser.error(
+            'argument {}: no such file or directory "{}"'.format(argument, path)
+        )
+    except PermissionError:
+        parser.error('argument {}: permission denied "{}"'.format(argument, path))
+
+
+def stream_main(preprocessor: Preprocessor, args: argparse.Namespace) -> None:
+    """processes the input with Preprocessor.process_stream"""
+    if isinstance(args.input, Path):
+        input_name = str(args.input)
+        reader = open_file(args.input, "r", "input")
     else:
-        args = parser.parse_args(argv)
+        input_name = "<stdin>"
+        reader = args.input
+    if isinstance(args.output, Path):
+        writer = open_file(args.output, "w", "-o/--output")
+    else:
+        writer = args.output
+    try:
+        preprocessor.process_stream(reader, writer, input_name)
+    finally:
+        if isinstance(args.input, Path):
+            reader.close()
+        if isinstance(args.output, Path):
+            writer.close()
 
-    if stderr.isatty():
-        preprocessor.use_color = True
 
-    process_options(preprocessor, args)
+def dependencies(preprocessor: Preprocessor, args: argparse.Namespace) -> str:
+    """returns the Makefile rule listing the files the output depends on"""
+    if args.dep_target is not None:
+        target = args.dep_target
+    elif isinstance(args.output, Path):
+        target = str(args.output)
+    else:
+        parser.error("argument -M/-MF/-MD: -MT or -o/--output required")
+    files = preprocessor.dependencies
+    if isinstance(args.input, Path):
+        files = [str(args.input)] + [dep for dep in files if dep != str(args.input)]
+    return dependency_rule(target, files, args.dep_phony)
+
+
+def write_dependencies(preprocessor: Preprocessor, args: argparse.Namespace) -> None:
+    """writes the dependency file(s) requested by -MF and -MD"""
+    paths = []
+    if args.dep_file is not None:
+        paths.append((args.dep_file, "-MF"))
+    if args.dep_output:
+        paths.append((Path(str(args.output) + ".d"), "-MD"))
+    for path, argument in paths:
+        write_file(
+            path, dependencies(preprocessor, args), argument, args.write_if_changed
+        )
+
+
+def result_key(
+    preprocessor: Preprocessor, args: argparse.Namespace, contents: str, name: str
+) -> str:
+    """returns the key of the document in a ResultCache:
+    a hash of its contents and of all options that can change its output"""
+    output_name = str(args.output) if isinstance(args.output, Path) else "<stdout>"
+    options = {
+        "version": PREPROCESSOR_VERSION,
+        "input": name,
+        "output": output_name,
+        "begin": preprocessor.token_begin,
+        "end": preprocessor.token_end,
+        "recursion_depth": preprocessor.max_recursion_depth,
+        "defines": [str(define) for define in args.define],
+        "define_files": args.define_file,
+        "include_path": preprocessor.include_path,
+        "include_once": preprocessor.include_once,
+        "warnings": preprocessor.warning_mode.name,
+        "silent": preprocessor.silent_warnings,
+        "color": preprocessor.use_color,
+    }
+    return hash_key(contents, json.dumps(options, sort_keys=True))
+
+
+def cached_process(
+    preprocessor: Preprocessor,
+    cache: DiskCache,
+    args: argparse.Namespace,
+    contents: str,
+    name: str,
+) -> str:
+    """processes the document using cache (the preprocessor's disk_cache):
+    reuses the previous result (output and printed warnings) if neither the
+    document, the options nor the files it depends on changed. Otherwise, the
+    document is compiled and rendered, and its result saved unless it uses
+    commands like date, whose result changes between runs"""
+    results = ResultCache(cache)
+    key = result_key(preprocessor, args, contents, name)
+    cached = results.get(key)
+    if cached is not None:
+        sys.stderr.write(cached.diagnostics)
+        preprocessor.dependencies = list(cached.dependencies)
+        preprocessor.absent_dependencies = list(cached.absent)
+        return cached.output
+    diagnostics = StringIO()
+    try:
+        with redirect_stderr(diagnostics):
+            result = preprocessor.render(preprocessor.compile(contents, name))
+    finally:
+        sys.stderr.write(diagnostics.getvalue())
+    if not preprocessor.volatile:
+        results.put(
+            key,
+            CachedResult(
+                result,
+                diagnostics.getvalue(),
+                preprocessor.dependencies,
+                preprocessor.absent_dependencies,
+            ),
+        )
+    cache.trim()
+    return result
+
+
+def process_document(preprocessor: Preprocessor, args: argparse.Namespace) -> None:
+    """reads args.input, processes it and writes the result to args.output"""
+    if args.stream:
+        stream_main(preprocessor, args)
+        write_dependencies(preprocessor, args)
+        return
 
     if isinstance(args.input, Path):
         try:
@@ -159,25 +382,262 @@ def preprocessor_main(argv: Optional[List[str]] = None) -> None:
         input_name = "<stdin>"
         contents = args.input.read()
 
-    result = preprocessor.process(contents, input_name)
+    # verbatim includes are copied to the output file without being read,
+    # cached results and compared outputs need the actual text
+    preprocessor.defer_verbatim = (
+        args.copy_verbatim
+        and isinstance(args.output, Path)
+        and preprocessor.disk_cache is None
+        and not (args.write_if_changed or args.deps_only)
+    )
+    if preprocessor.disk_cache is not None:
+        result = cached_process(
+            preprocessor, preprocessor.disk_cache, args, contents, input_name
+        )
+    else:
+        result = preprocessor.process(contents, input_name)
+    if args.deps_only:
+        result = dependencies(preprocessor, args)
+
+    if isinstance(args.output, Path):
+        output: Union[str, List[str]] = result
+        if preprocessor.defer_verbatim:
+            output = preprocessor.split_deferred(result)
+        write_file(args.output, output, "-o/--output", args.write_if_changed)
+    else:
+        # write to stdout
+        args.output.write(result)
+    write_dependencies(preprocessor, args)
+
 
+def batch_documents(args: argparse.Namespace) -> List[Tuple[Any, Any]]:
+    """returns the list of (input, output) to process,
+    from the input, --output, --output-dir and --files-from arguments"""
+    inputs: List[Any] = list(args.input)
+    if args.files_from is not None:
+        with open_file(args.files_from, "r", "--files-from") as file:
+            inputs.extend(Path(line.strip()) for line in file if line.strip())
+    if args.output_dir is None:
+        if len(inputs) > 1 or args.files_from is not None:
+            parser.error("processing several inputs requires --output-dir")
+        if not inputs:
+            inputs.append(stdin)
+        return [(inputs[0], args.output)]
     if isinstance(args.output, Path):
+        parser.error("argument -o/--output: not allowed with --output-dir")
+    if args.deps_only or args.dep_file is not None:
+        parser.error("argument -M/-MF: not allowed with --output-dir, use -MD")
+    if not inputs:
+        parser.error("argument --output-dir: no input files")
+    documents = []
+    outputs = set()
+    for path in inputs:
+        output = args.output_dir / path.name
+        if output in outputs:
+            parser.error('argument --output-dir: duplicate output "{}"'.format(output))
+        outputs.add(output)
+        documents.append((path, output))
+    return documents
+
+
+def new_preprocessor(args: argparse.Namespace, file_cache: FileCache) -> Preprocessor:
+    """returns a new Preprocessor configured for the document
+    with input args.input and output args.output"""
+    preprocessor = Preprocessor()
+    preprocessor.warning_mode = WarningMode.PRINT
+    preprocessor.error_mode = ErrorMode.PRINT_AND_EXIT
+    preprocessor.file_cache = file_cache
+
+    if stderr.isatty():
+        preprocessor.use_color = True
+
+    process_options(preprocessor, args)
+    return preprocessor
+
+
+def run_document(args: argparse.Namespace, file_cache: FileCache) -> None:
+    """processes a single document with a new Preprocessor,
+    args.input and args.output are the document's input and output"""
+    process_document(new_preprocessor(args, file_cache), args)
+    if isinstance(args.output, Path):
+        file_cache.forget(str(args.output))
+
+
+def watch_document(
+    args: argparse.Namespace, file_cache: FileCache, previous: Set[str]
+) -> Set[str]:
+    """processes a document in watch mode, errors don't exit.
+    returns the files it depends on (as absolute paths), on error these
+    also include the files it depended on previously"""
+    # missing files may have been created since the last build
+    file_cache.forget_resolutions()
+    preprocessor = new_preprocessor(args, file_cache)
+    try:
+        process_document(preprocessor, args)
+        dependencies = set()
+    except SystemExit:
+        dependencies = set(previous)
+    if isinstance(args.output, Path):
+        file_cache.forget(str(args.output))
+    dependencies.add(abspath(args.input))
+    dependencies.update(abspath(path) for path in preprocessor.dependencies)
+    dependencies.update(abspath(path) for path in preprocessor.absent_dependencies)
+    # a document including its own output would be rebuilt endlessly
+    if isinstance(args.output, Path):
+        dependencies.discard(abspath(args.output))
+    return dependencies
+
+
+def watch_documents(
+    documents: List[argparse.Namespace], watcher: Optional[Watcher] = None
+) -> None:
+    """processes documents, then processes them again each time one of
+    the files they depend on changes, until interrupted"""
+    file_cache = FileCache()
+    if watcher is None:
+        watcher = make_watcher()
+    try:
+        dependencies = [watch_document(args, file_cache, set()) for args in documents]
+        while True:
+            watcher.watch(set().union(*dependencies))
+            changed = watcher.wait()
+            for i, args in enumerate(documents):
+                if dependencies[i] & changed:
+                    print(
+                        "{}: rebuilding {}".format(PREPROCESSOR_NAME, args.input),
+                        file=stderr,
+                    )
+                    dependencies[i] = watch_document(args, file_cache, dependencies[i])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+        file_cache.close()
+
+
+# FileCache of each process of the pool
+worker_file_cache: Optional[FileCache] = None
+
+
+def run_worker(args: argparse.Namespace) -> Tuple[str, str, Optional[int]]:
+    """runs run_document in a process of the pool
+    returns its stdout and stderr output and its exit code (None if it didn't exit)"""
+    out = StringIO()
+    err = StringIO()
+    code: Optional[int] = None
+    global worker_file_cache
+    if worker_file_cache is None:
+        worker_file_cache = FileCache(
+            shared=args.shared_files, shared_maxsize=args.shared_maxsize
+        )
+    with redirect_stdout(out), redirect_stderr(err):
         try:
-            with open(args.output, "w") as file:
-                file.write(result)
-        except FileNotFoundError:
+            run_document(args, worker_file_cache)
+        except SystemExit as error:
+            if error.code is None:
+                code = 0
+            elif isinstance(error.code, int):
+                code = error.code
+            else:
+                # like the interpreter: print the message and exit with 1
+                print(error.code, file=sys.stderr)
+                code = 1
+    return out.getvalue(), err.getvalue(), code
+
+
+def run_pool(
+    documents: List[argparse.Namespace], jobs: int, shared_includes: bool = False
+) -> None:
+    """processes documents on a pool of jobs processes.
+    Messages are printed in document order, and the first document that exits
+    (on error for instance) stops the run with the same exit code,
+    as processing them in order would (later documents may already be written).
+    if shared_includes, the contents of included files are shared by all processes"""
+    manager = Manager() if shared_includes else None
+    shared = None if manager is None else manager.dict()
+    # the workers together add at most the size of a single cache
+    shared_maxsize = CACHE_MAXSIZE // jobs
+    for document in documents:
+        document.shared_files = shared
+        document.shared_maxsize = shared_maxsize
+    try:
+        with ProcessPoolExecutor(jobs) as executor:
+            futures = [executor.submit(run_worker, doc) for doc in documents]
+            for future in futures:
+                out, err, code = future.result()
+                sys.stdout.write(out)
+                sys.stderr.write(err)
+                if code is not None:
+                    for pending in futures:
+                        pending.cancel()
+                    sys.stdout.flush()
+                    exit(code)
+    finally:
+        if manager is not None:
+            manager.shutdown()
+
+
+def preprocessor_main(argv: Optional[List[str]] = None) -> None:
+    """main function for the preprocessor
+    handles arguments, reads contents from file
+    and write result to output file.
+    argv defaults to sys.argv
+
+    When given several inputs, each is processed by a new Preprocessor,
+    included files are shared between them through a FileCache.
+    With --jobs, they are processed on a pool of processes
+    """
+    if argv is None:
+        args = parser.parse_args()
+    else:
+        args = parser.parse_args(argv)
+
+    if args.watch and args.input == [] and args.files_from is None:
+        parser.error("argument --watch: input files required")
+    if args.write_if_changed and args.stream:
+        parser.error("argument --write-if-changed: not allowed with --stream")
+    if args.deps_only and args.stream:
+        parser.error("argument -M: not allowed with --stream")
+    if args.dep_output and args.output_dir is None:
+        if not isinstance(args.output, Path):
+            parser.error("argument -MD: -o/--output or --output-dir required")
+    if args.jobs < 0:
+        parser.error("argument --jobs/-j: number must be positive")
+    if args.shared_includes and args.jobs == 1:
+        parser.error("argument --shared-includes: requires --jobs")
+    jobs = args.jobs if args.jobs != 0 else cpu_count() or 1
+
+    documents = []
+    for input_file, output_file in batch_documents(args):
+        document_args = argparse.Namespace(**vars(args))
+        document_args.input = input_file
+        document_args.output = output_file
+        documents.append(document_args)
+
+    if args.output_dir is not None:
+        try:
+            makedirs(args.output_dir, exist_ok=True)
+        except OSError:
             parser.error(
-                'argument -o/--output: no such file or directory "{}"'.format(
-                    args.output
+                'argument --output-dir: can\'t create directory "{}"'.format(
+                    args.output_dir
                 )
             )
-        except PermissionError:
-            parser.error(
-                'argument -o/--output: permission denied "{}"'.format(args.output)
-            )
-    else:
-        # write to stdout
-        args.output.write(result)
+
+    if args.watch:
+        watch_documents(documents)
+        return
+
+    if jobs > 1 and len(documents) > 1:
+        run_pool(documents, jobs, args.shared_includes)
+        return
+
+    file_cache = FileCache()
+    try:
+        for document_args in documents:
+            run_document(document_args, file_cache)
+    finally:
+        file_cache.close()
 
 
 if __name__ == "__main__":
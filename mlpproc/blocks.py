@@ -2,19 +2,15 @@
 Definitions of default preprocessor blocks
 """
 import argparse
-import re
-from typing import Any, Iterable, Optional, Tuple
-
-from .conditions import condition_eval, find_matching_close_parenthese
-from .defs import (
-    REGEX_IDENTIFIER,
-    REGEX_IDENTIFIER_END,
-    REGEX_INTEGER,
-    ArgumentParserNoExit,
-    TokenMatch,
-    to_integer,
-)
+from bisect import bisect_left
+from typing import Any, Iterable, List, Optional, Tuple
+
+from .buffer import TextOrBuffer
+from .conditions import condition_eval
+from .defs import ArgumentParserNoExit, TokenMatch, to_integer
+from .patterns import PatternKind, get_pattern
 from .preprocessor import Block, Command, Preprocessor
+from .tokens import Token
 
 # ============================================================
 # simple blocks (comment, void, block, verbatim)
@@ -67,7 +63,7 @@ class Blck_Block(Block):
         clipboard to local block"""
         split = preprocessor.split_args(args)
         try:
-            arguments = self.parser.parse_args(split)
+            arguments = self.parser.bind(split)
         except argparse.ArgumentError:
             preprocessor.send_error(
                 "invalid-argument",
@@ -238,6 +234,7 @@ class Blck_Atlabel(Block):
             preprocessor.current_position.end, "in block atlabel"
         )
         preprocessor.command_vars["atlabel"][lbl] = preprocessor.parse(contents)
+        preprocessor.state_changed()
         preprocessor.context.pop()
         return ""
 
@@ -270,7 +267,12 @@ class Blck_Atlabel(Block):
 
 
 class Fnl_AtLabel(Command):
-    def __call__(self, preprocessor: Preprocessor, string: str) -> str:
+    edits_buffer = True
+    inspects_text = False  # only inserts text at labels
+
+    def __call__(
+        self, preprocessor: Preprocessor, string: TextOrBuffer
+    ) -> TextOrBuffer:
         """places atlabel blocks at all matching labels"""
         if "atlabel" in preprocessor.command_vars:
             deletions = []
@@ -310,7 +312,7 @@ class Blck_For(Block):
                             range(start, stop, step)
             for <ident> in space separated list " argument with spaces"
         """
-        match = re.match(r"^\s*({})\s+in\s+".format(REGEX_IDENTIFIER), args)
+        match = get_pattern(PatternKind.FOR).match(args)
         if match is None:
             preprocessor.send_error(
                 "invalid-argument",
@@ -325,10 +327,7 @@ class Blck_For(Block):
         args = args[match.end() :].strip()
         iterator: Iterable[Any] = []
         if args[0:5] == "range":
-            regex = r"range\((?:\s*({nb})\s*,)?\s*({nb})\s*(?:,\s*({nb})\s*)?\)".format(
-                nb=REGEX_INTEGER
-            )
-            match = re.match(regex, args)
+            match = get_pattern(PatternKind.FOR_RANGE).match(args)
             if match is None:
                 preprocessor.send_error(
                     "invalid-argument",
@@ -369,6 +368,7 @@ class Blck_For(Block):
                 doc = "Command defined in for loop: {} = '{}'".format(ident, value)
 
             preprocessor.commands[ident] = Defined_Value()
+            preprocessor.state_changed()
             preprocessor.context.update(
                 preprocessor.current_position.end, "in for block"
             )
@@ -422,7 +422,7 @@ class Blck_Cut(Block):
         """
         split = preprocessor.split_args(args)
         try:
-            arguments = self.parser.parse_args(split)
+            arguments = self.parser.bind(split)
         except argparse.ArgumentError:
             preprocessor.send_error(
                 "invalid-argument",
@@ -439,6 +439,7 @@ class Blck_Cut(Block):
             preprocessor.command_vars["clipboard"] = {clipboard: (context, contents)}
         else:
             preprocessor.command_vars["clipboard"][clipboard] = (context, contents)
+        preprocessor.state_changed()
         return ""
 
     doc = """
@@ -472,41 +473,57 @@ class Blck_Cut(Block):
 
 class Blck_If(Block):
     def find_elifs_and_else(
-        self, preproc: Preprocessor, string: str
+        self,
+        preproc: Preprocessor,
+        string: str,
+        start: int = 0,
+        tokens: Optional[List[Token]] = None,
     ) -> Tuple[int, int, Optional[str]]:
-        """returns a tuple indicating the next elif/else:
+        """returns a tuple indicating the next elif/else in string[start:]:
         (-1,-1,None) -> no matching elif/else
         (begin, end, None) -> matching else at string[begin:end]
-        (begin, end, str) -> matchin elif with arguments str at string[begin:end]"""
-        tokens = preproc._find_tokens(string)
+        (begin, end, str) -> matchin elif with arguments str at string[begin:end]
+        tokens should be preproc._find_tokens(string) if given, this avoids
+        searching tokens again when looking for successive elifs"""
+        if tokens is None:
+            tokens = preproc._find_tokens(string, start)
         depth = 0
-        endif_regex = r"\s*{}if\s*{}".format(
-            re.escape(preproc.token_endblock), re.escape(preproc.token_end)
+        flags = preproc.re_flags
+        token_end = preproc.token_end
+        endif_regex = get_pattern(
+            PatternKind.ENDIF,
+            token_end=token_end,
+            token_endblock=preproc.token_endblock,
+            flags=flags,
         )
-        if_regex = r"\s*if(?:{}|{})".format(
-            re.escape(preproc.token_end), REGEX_IDENTIFIER_END
-        )
-        elif_regex = r"\s*(elif)(?:{}|{})".format(
-            re.escape(preproc.token_end), REGEX_IDENTIFIER_END
-        )
-        else_regex = r"\s*else\s*{}".format(re.escape(preproc.token_end))
-        for i, (begin, end, token) in enumerate(tokens):
+        if_regex = get_pattern(PatternKind.IF, token_end=token_end, flags=flags)
+        elif_regex = get_pattern(PatternKind.ELIF, token_end=token_end, flags=flags)
+        else_regex = get_pattern(PatternKind.ELSE, token_end=token_end, flags=flags)
+        len_tokens = len(tokens)
+        for i in range(bisect_left(tokens, (start,)), len_tokens):
+            begin, end, token = tokens[i]
             if token == TokenMatch.OPEN:
-                if re.match(if_regex, string[end:], preproc.re_flags) is not None:
+                if if_regex.match(string, end) is not None:
                     depth += 1
-                elif re.match(endif_regex, string[end:], preproc.re_flags) is not None:
+                elif endif_regex.match(string, end) is not None:
                     depth -= 1
                 elif depth == 0:
-                    match_else = re.match(else_regex, string[end:], preproc.re_flags)
-                    match_elif = re.match(elif_regex, string[end:], preproc.re_flags)
+                    match_else = else_regex.match(string, end)
                     if match_else is not None:
-                        return (begin, end + match_else.end(), None)
+                        return (begin, match_else.end(), None)
+                    match_elif = elif_regex.match(string, end)
                     if match_elif is not None:
-                        parenthese = [
-                            "(" if x[2] == TokenMatch.OPEN else ")" for x in tokens
-                        ]
-                        j = find_matching_close_parenthese(parenthese, i)
-                        if j == len(tokens):
+                        j = i + 1
+                        open_nb = 0
+                        while j < len_tokens:
+                            if tokens[j][2] == TokenMatch.OPEN:
+                                open_nb += 1
+                            else:
+                                open_nb -= 1
+                                if open_nb == -1:
+                                    break
+                            j += 1
+                        if j == len_tokens:
                             preproc.context.update(
                                 begin + preproc.current_position.end, "in elif"
                             )
@@ -521,8 +538,11 @@ class Blck_If(Block):
                                 ),
                             )
                             preproc.context.pop()
-                        end += match_elif.end(1)
-                        return (begin, tokens[j][1], string[end : tokens[j][0]])
+                        return (
+                            begin,
+                            tokens[j][1],
+                            string[match_elif.end(1) : tokens[j][0]],
+                        )
         return (-1, -1, None)
 
     def __call__(self, preprocessor: Preprocessor, args: str, contents: str) -> str:
@@ -533,12 +553,13 @@ class Blck_If(Block):
             {% endif %}
         """
         value = condition_eval(preprocessor, args)
+        tokens = preprocessor._parsed_text(contents).tokens
         pos_0 = 0
         desc = "in if block"
         while True:
-            else_info = self.find_elifs_and_else(preprocessor, contents[pos_0:])
+            else_info = self.find_elifs_and_else(preprocessor, contents, pos_0, tokens)
             if value:
-                endelse = pos_0 + else_info[0] if else_info[0] != -1 else len(contents)
+                endelse = else_info[0] if else_info[0] != -1 else len(contents)
                 preprocessor.context.update(
                     pos_0 + preprocessor.current_position.end, desc
                 )
@@ -553,14 +574,14 @@ class Blck_If(Block):
                 desc = "in else"
             else:
                 preprocessor.context.update(
-                    pos_0 + else_info[0] + preprocessor.current_position.end,
+                    else_info[0] + preprocessor.current_position.end,
                     "in elif evaluation",
                 )
                 args = preprocessor.parse(else_info[2])
                 preprocessor.context.pop()
                 value = condition_eval(preprocessor, args)
                 desc = "in elif"
-            pos_0 += else_info[1]
+            pos_0 = else_info[1]
 
     doc = """
         Used to select wether or not to render a chunk of text
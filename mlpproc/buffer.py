@@ -0,0 +1,143 @@
+"""This module implements the document buffer used by the preprocessor
+
+It contains:
+
+- class TextBuffer
+    a mutable string stored as a piece table: a list of slices
+    of immutable strings. Replacing part of the text only adds or
+    removes slices, the text is copied once when converted back to str.
+
+- TypeVar TextOrBuffer
+    used by functions that accept (and return) either a str or a TextBuffer
+"""
+from typing import List, Tuple, TypeVar, Union
+
+# a slice of a string: (source, start, end)
+Piece = Tuple[str, int, int]
+
+
+class TextBuffer:
+    """A mutable string, stored as a list of (source, start, end) slices.
+
+    Positions are always relative to the start of the buffer's current text.
+    Lookups start from the last accessed piece (the finger), so accesses and
+    edits that move through the text from left to right (like the parser and
+    final actions do) don't need to walk through the whole piece list."""
+
+    _pieces: List[Piece]
+    _length: int
+    _finger: int
+    _finger_pos: int
+
+    def __init__(self: "TextBuffer", string: str = "") -> None:
+        """initializes a buffer containing string"""
+        self._pieces = [(string, 0, len(string))] if string else []
+        self._length = len(string)
+        self._finger = 0
+        self._finger_pos = 0
+
+    def __len__(self: "TextBuffer") -> int:
+        return self._length
+
+    def __str__(self: "TextBuffer") -> str:
+        """returns the buffer contents.
+        The result is stored as the sole piece of the buffer,
+        so converting an unmodified buffer again is free"""
+        if len(self._pieces) == 1:
+            source, start, end = self._pieces[0]
+            if start == 0 and end == len(source):
+                return source
+        string = "".join(source[start:end] for source, start, end in self._pieces)
+        self._pieces = [(string, 0, len(string))] if string else []
+        self._finger = 0
+        self._finger_pos = 0
+        return string
+
+    def __repr__(self: "TextBuffer") -> str:
+        return "TextBuffer({!r})".format(str(self))
+
+    def __getitem__(self: "TextBuffer", key: Union[int, slice]) -> str:
+        """buffer[i] and buffer[i:j] work like they do on str (no step allowed)"""
+        if isinstance(key, slice):
+            start, end, step = key.indices(self._length)
+            if step != 1:
+                raise ValueError("TextBuffer slices don't support steps")
+            return self.substring(start, end)
+        if key < 0:
+            key += self._length
+        if not 0 <= key < self._length:
+            raise IndexError("TextBuffer index out of range")
+        source, start, _ = self._pieces[self._seek(key)]
+        return source[start + key - self._finger_pos]
+
+    def _seek(self: "TextBuffer", pos: int) -> int:
+        """moves the finger to the piece containing pos and returns its index.
+        returns len(self._pieces) when pos is the end of the buffer"""
+        pieces = self._pieces
+        index = self._finger
+        piece_pos = self._finger_pos
+        while index > 0 and piece_pos > pos:
+            index -= 1
+            _, start, end = pieces[index]
+            piece_pos -= end - start
+        len_pieces = len(pieces)
+        while index < len_pieces:
+            _, start, end = pieces[index]
+            if pos < piece_pos + end - start:
+                break
+            piece_pos += end - start
+            index += 1
+        self._finger = index
+        self._finger_pos = piece_pos
+        return index
+
+    def _split(self: "TextBuffer", pos: int) -> int:
+        """splits pieces so that one starts at pos, returns its index"""
+        index = self._seek(pos)
+        if index == len(self._pieces) or self._finger_pos == pos:
+            return index
+        source, start, end = self._pieces[index]
+        cut = start + pos - self._finger_pos
+        self._pieces[index : index + 1] = [(source, start, cut), (source, cut, end)]
+        self._finger = index + 1
+        self._finger_pos = pos
+        return index + 1
+
+    def substring(self: "TextBuffer", start: int, end: int) -> str:
+        """returns the text between start and end (same as str(self)[start:end])"""
+        if start >= end:
+            return ""
+        index = self._seek(start)
+        source, piece_start, piece_end = self._pieces[index]
+        offset = piece_start + start - self._finger_pos
+        if end - start <= piece_end - offset:
+            # fast path: text is in a single piece
+            return source[offset : offset + end - start]
+        parts = [source[offset:piece_end]]
+        remaining = end - start - (piece_end - offset)
+        while remaining > 0:
+            index += 1
+            source, piece_start, piece_end = self._pieces[index]
+            length = min(remaining, piece_end - piece_start)
+            parts.append(source[piece_start : piece_start + length])
+            remaining -= length
+        return "".join(parts)
+
+    def replace(self: "TextBuffer", start: int, end: int, text: str) -> None:
+        """replaces the text between start and end with text.
+        start and end must satisfy 0 <= start <= end <= len(self)"""
+        if not 0 <= start <= end <= self._length:
+            raise IndexError(
+                "invalid range [{}, {}] in TextBuffer of length {}".format(
+                    start, end, self._length
+                )
+            )
+        first = self._split(start)
+        last = self._split(end)
+        self._pieces[first:last] = [(text, 0, len(text))] if text else []
+        self._length += len(text) - (end - start)
+        self._finger = first
+        self._finger_pos = start
+
+
+TextOrBuffer = TypeVar("TextOrBuffer", str, TextBuffer)
@@ -0,0 +1,264 @@
+"""This module implements the on-disk cache used by the command line
+
+It contains:
+
+- class DiskCache
+    a directory of binary entries, grouped in namespaces and identified by keys,
+    with a bounded total size (least recently used entries are evicted first)
+
+- class CacheStats
+    returned by DiskCache.check
+
+- class ResultCache
+    stores the results of processing documents in a DiskCache,
+    along with the hashes of the files they depend on
+
+- class CachedResult
+    an entry of a ResultCache
+
+- function hash_key
+    computes entry keys from strings
+"""
+import json
+import os
+from hashlib import sha256
+from tempfile import mkstemp
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+# entries are: sha256(payload) + payload
+DIGEST_SIZE = 32
+
+
+def hash_key(*parts: str) -> str:
+    """returns a hex key identifying the tuple of strings parts"""
+    digest = sha256()
+    for part in parts:
+        data = part.encode("utf-8", "surrogatepass")
+        digest.update(len(data).to_bytes(8, "little"))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+class CacheStats(NamedTuple):
+    """Result of DiskCache.check"""
+
+    entries: int
+    size: int
+    removed: int
+
+
+class DiskCache:
+    """A size-bounded cache of binary entries stored in a directory
+
+    Entries are stored in <directory>/<namespace>/<key[:2]>/<key>
+    along with a checksum, corrupted entries are ignored (and removed).
+    Entries are written to a temporary file and moved in place, so
+    several processes can share the same directory.
+
+    Reading an entry updates its modification time, trim() removes the entries
+    with the oldest modification times until the size is under max_size."""
+
+    directory: str
+    max_size: int
+
+    def __init__(
+        self: "DiskCache", directory: str, max_size: int = 256 * 1024 * 1024
+    ) -> None:
+        self.directory = directory
+        self.max_size = max_size
+
+    def _path(self: "DiskCache", namespace: str, key: str) -> str:
+        return os.path.join(self.directory, namespace, key[:2], key)
+
+    def get(self: "DiskCache", namespace: str, key: str) -> Optional[bytes]:
+        """returns the entry's data, None if absent or invalid"""
+        path = self._path(namespace, key)
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+        except OSError:
+            return None
+        payload = data[DIGEST_SIZE:]
+        if sha256(payload).digest() != data[:DIGEST_SIZE]:
+            self._remove(path)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return payload
+
+    def put(self: "DiskCache", namespace: str, key: str, payload: bytes) -> None:
+        """adds or replaces an entry, fails silently if it can't be written"""
+        path = self._path(namespace, key)
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            handle, tmp_path = mkstemp(dir=directory, prefix=".tmp-")
+            with os.fdopen(handle, "wb") as file:
+                file.write(sha256(payload).digest())
+                file.write(payload)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _remove(path: str) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    def _entries(self: "DiskCache") -> List[Tuple[float, int, str]]:
+        """returns (mtime, size, path) of all files in the cache"""
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def size(self: "DiskCache") -> int:
+        """returns the total size of the entries, in bytes"""
+        return sum(size for _, size, _ in self._entries())
+
+    def trim(self: "DiskCache") -> int:
+        """evicts least recently used entries until size <= max_size
+        returns the number of entries removed"""
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            if self._remove(path):
+                total -= size
+                removed += 1
+        return removed
+
+    def check(self: "DiskCache") -> CacheStats:
+        """removes invalid entries (bad checksum or leftover temporary files)
+        then evicts entries to respect max_size"""
+        removed = 0
+        for _, _, path in self._entries():
+            if os.path.basename(path).startswith(".tmp-"):
+                removed += self._remove(path)
+                continue
+            try:
+                with open(path, "rb") as file:
+                    data = file.read()
+            except OSError:
+                continue
+            if sha256(data[DIGEST_SIZE:]).digest() != data[:DIGEST_SIZE]:
+                removed += self._remove(path)
+        removed += self.trim()
+        entries = self._entries()
+        return CacheStats(len(entries), sum(size for _, size, _ in entries), removed)
+
+    def clean(self: "DiskCache") -> int:
+        """removes all entries, returns the number of entries removed"""
+        removed = 0
+        for _, _, path in self._entries():
+            removed += self._remove(path)
+        for root, dirs, _ in os.walk(self.directory, topdown=False):
+            for name in dirs:
+                try:
+                    os.rmdir(os.path.join(root, name))
+                except OSError:
+                    pass
+        return removed
+
+
+def hash_file(path: str) -> str:
+    """returns the hex sha256 of the file's contents, "" if it can't be read"""
+    digest = sha256()
+    try:
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 16), b""):
+                digest.update(block)
+    except OSError:
+        return ""
+    return digest.hexdigest()
+
+
+class CachedResult(NamedTuple):
+    """The result of processing a document"""
+
+    output: str
+    diagnostics: str  # warnings printed while processing
+    dependencies: List[str]  # see Preprocessor.dependencies
+    absent: List[str] = []  # see Preprocessor.absent_dependencies
+
+
+class ResultCache:
+    """Results of processing documents, stored in a DiskCache
+
+    Like ccache's direct mode, results are found in two steps:
+    - a manifest, identified by a key computed from the document
+      and the options, lists the files read by previous results
+      (with their hashes) and the key of these results
+    - the first result whose files have the same hashes is used.
+    So a result is reused only if all the files it depends on are unchanged.
+    The files it depends on include absent ones (hashed as ""), whose creation
+    could change the result"""
+
+    cache: DiskCache
+    # number of results listed by a manifest
+    max_candidates: int = 16
+    _hashes: Dict[str, str]
+
+    def __init__(self: "ResultCache", cache: DiskCache) -> None:
+        self.cache = cache
+        self._hashes = dict()
+
+    def file_hash(self: "ResultCache", path: str) -> str:
+        """returns the hash of a file, only reading it the first time"""
+        if path not in self._hashes:
+            self._hashes[path] = hash_file(path)
+        return self._hashes[path]
+
+    def _manifest(self: "ResultCache", key: str) -> List[Tuple[List[str], str]]:
+        """returns the (files, result key) of the manifest"""
+        data = self.cache.get("manifest", key)
+        if data is not None:
+            try:
+                return [(files, result) for files, result in json.loads(data)]
+            except (ValueError, TypeError):
+                pass
+        return []
+
+    def get(self: "ResultCache", key: str) -> Optional[CachedResult]:
+        """returns the cached result of the document identified by key,
+        None if there is none or if the files it read have changed"""
+        for files, result_key in self._manifest(key):
+            hashes = [self.file_hash(path) for path in files]
+            if result_key != hash_key(key, *files, *hashes):
+                continue
+            data = self.cache.get("result", result_key)
+            if data is None:
+                continue
+            try:
+                output, diagnostics, dependencies, absent = json.loads(data)
+                return CachedResult(output, diagnostics, dependencies, absent)
+            except (ValueError, TypeError):
+                continue
+        return None
+
+    def put(self: "ResultCache", key: str, result: CachedResult) -> None:
+        """stores the result of the document identified by key"""
+        files = sorted(set(result.dependencies).union(result.absent))
+        hashes = [self.file_hash(path) for path in files]
+        result_key = hash_key(key, *files, *hashes)
+        self.cache.put("result", result_key, json.dumps(list(result)).encode())
+        manifest = [(files, result_key)]
+        for candidate in self._manifest(key):
+            if candidate[1] != result_key:
+                manifest.append(candidate)
+        manifest = manifest[: self.max_candidates]
+        self.cache.put("manifest", key, json.dumps(manifest).encode())
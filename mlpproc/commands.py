@@ -5,18 +5,21 @@ import argparse
 import re
 from datetime import datetime
 from os.path import abspath, dirname, getsize, isfile, join
-from typing import List
+from typing import Any, List, Mapping, Optional, Tuple
 
 from .context import FileDescriptor
 from .defs import (
     PREPROCESSOR_VERSION,
-    REGEX_IDENTIFIER_WRAPPED,
     ArgumentParserNoExit,
     get_identifier_name,
+    is_identifier,
     is_integer,
     process_string,
     to_integer,
 )
+from .files import file_identity, searched_paths
+from .memo import RenderLog
+from .patterns import PatternKind, get_pattern
 from .preprocessor import Command, Preprocessor
 
 # ============================================================
@@ -128,6 +131,152 @@ macro_parser = ArgumentParserNoExit(prog="macro", add_help=False)
 macro_parser.add_argument("vars", nargs="*")  # arbitrary number of arguments
 
 
+def expand_definition(pre: Preprocessor, name: str, text: str) -> str:
+    """parses the text printed by the defined command name"""
+    # text without tokens would be left unchanged by parse
+    if pre.token_begin not in text and pre.token_end not in text:
+        return text
+    pre.context.update(
+        pre.current_position.cmd_argbegin,
+        "in expansion of defined command {}".format(name),
+    )
+    parsed = pre.parse(text)
+    pre.context.pop()
+    return parsed
+
+
+class MacroBody:
+    """One overload of a defined macro, stored in command_vars["def"]
+    under "<name>:<number of arguments>".
+    The body is compiled at definition: literals alternate with
+    the indexes of the arguments placed between them (slots)"""
+
+    __slots__ = ("name", "args", "literals", "slots")
+
+    name: str
+    args: List[str]
+    literals: List[str]
+    slots: List[int]
+
+    def __init__(
+        self: "MacroBody",
+        name: str,
+        args: List[str],
+        literals: List[str],
+        slots: List[int],
+    ) -> None:
+        self.name = name
+        self.args = args
+        self.literals = literals
+        self.slots = slots
+
+    @property
+    def doc(self: "MacroBody") -> str:
+        return "{} {}".format(self.name, " ".join(self.args))
+
+    def __call__(self: "MacroBody", pre: Preprocessor, cmd_args: List[str]) -> str:
+        """expands the macro with the given arguments"""
+        literals = self.literals
+        pieces = [literals[0]]
+        for slot, literal in zip(self.slots, literals[1:]):
+            pieces.append(cmd_args[slot])
+            pieces.append(literal)
+        return expand_definition(pre, self.name, "".join(pieces))
+
+
+class Macro(Command):
+    """The command of a defined macro: parses arguments
+    and calls the overload of command_vars["def"] with that many arguments.
+    Overloads are looked up on call, so defining one is O(1)"""
+
+    __slots__ = ("name", "preprocessor")
+
+    name: str
+    preprocessor: Preprocessor
+
+    def __init__(self: "Macro", preprocessor: Preprocessor, name: str) -> None:
+        self.name = name
+        self.preprocessor = preprocessor
+
+    def overloads(self: "Macro") -> List[MacroBody]:
+        """returns the overloads of the macro, in order of definition"""
+        prefix = self.name + ":"
+        return [
+            body
+            for key, body in self.preprocessor.command_vars.get("def", dict()).items()
+            if key.startswith(prefix)
+        ]
+
+    def usage(self: "Macro") -> Tuple[str, str]:
+        """returns the usage message and the expected argument numbers"""
+        overloads = self.overloads()
+        usage = "usage: " + "\n       ".join(body.doc for body in overloads)
+        overload_nb = rreplace(
+            ", ".join(str(x) for x in sorted(len(body.args) for body in overloads)),
+            ", ",
+            " or ",
+        )
+        return usage, overload_nb
+
+    def __call__(self: "Macro", pre: Preprocessor, args_string: str) -> str:
+        split = pre.split_args(args_string)
+        try:
+            arguments = macro_parser.bind(split)
+        except argparse.ArgumentError:
+            pre.send_error(
+                "invalid-argument",
+                "invalid argument for macro.\n{}".format(self.usage()[0]),
+            )
+        body = pre.command_vars.get("def", dict()).get(
+            "{}:{}".format(self.name, len(arguments.vars))
+        )
+        if body is None:
+            usage, overload_nb = self.usage()
+            pre.send_error(
+                "invalid-argument",
+                (
+                    "invalid number of arguments for macro.\nexpected {} got {}.\n" "{}"
+                ).format(overload_nb, len(arguments.vars), usage),
+            )
+        return str(body(pre, arguments.vars))
+
+    @property
+    def doc(self: "Macro") -> str:  # type: ignore[override]
+        usage, overload_nb = self.usage()
+        return "Defined command for {} (expects {} arguments)\n{}".format(
+            self.name, overload_nb, usage
+        )
+
+
+class Constant(Command):
+    """A command defined by Cmd_Def.define_constants: prints its value,
+    takes no arguments. Unlike macros, constants have no overloads"""
+
+    __slots__ = ("name", "value")
+
+    name: str
+    value: str
+
+    def __init__(self: "Constant", name: str, value: str) -> None:
+        self.name = name
+        self.value = value
+
+    def __call__(self: "Constant", pre: Preprocessor, args_string: str) -> str:
+        if args_string.strip() != "":
+            pre.send_error(
+                "invalid-argument",
+                "invalid number of arguments for constant.\nexpected 0 got {}.\n"
+                "usage: {}".format(len(pre.split_args(args_string)), self.name),
+            )
+        return expand_definition(pre, self.name, self.value)
+
+    @property
+    def doc(self: "Constant") -> str:  # type: ignore[override]
+        return "Defined constant {} (expects 0 arguments)\nvalue: {}".format(
+            self.name, self.value
+        )
+
+
 class Cmd_Def(Command):
     @staticmethod
     def define_macro(
@@ -144,87 +293,45 @@ class Cmd_Def(Command):
         """
         # replace arg occurences with placeholder
         for i, arg in enumerate(args):
-            text = re.sub(
-                REGEX_IDENTIFIER_WRAPPED.format(re.escape(arg)),  # pattern
+            pattern = get_pattern(PatternKind.WHOLE_WORD, name=arg, flags=re.MULTILINE)
+            text = pattern.sub(
                 "\\1{}\\3".format("\000(arg {})\000".format(i)),  # placeholder
                 text,
-                flags=re.MULTILINE,
             )
-
-        class Defined_Cmd:
-            def __call__(
-                self,
-                pre: Preprocessor,
-                cmd_args: List[str],
-                text: str = text,
-                ident: str = name,
-            ) -> str:
-                """a defined macro command"""
-                for i, arg in enumerate(cmd_args):
-                    pattern = re.escape("\000(arg {})\000".format(i))
-                    text = re.sub(pattern, arg, text, flags=re.MULTILINE)
-
-                pre.context.update(
-                    pre.current_position.cmd_argbegin,
-                    "in expansion of defined command {}".format(ident),
-                )
-                parsed = pre.parse(text)
-                pre.context.pop()
-                return parsed
-
-            doc = "{} {}".format(name, " ".join(args))
+        # compile the body: literal text alternating with argument numbers
+        split = get_pattern(PatternKind.MACRO_SLOT).split(text)
+        literals = split[::2]
+        slots = [int(slot) for slot in split[1::2]]
 
         # place it in command_vars
         if "def" not in preprocessor.command_vars:
             preprocessor.command_vars["def"] = dict()
-        preprocessor.command_vars["def"][
-            "{}:{}".format(name, len(args))
-        ] = Defined_Cmd()
-
-        overloads = []
-        usages = []
-        for key, val in preprocessor.command_vars["def"].items():
-            if key.startswith(name + ":"):
-                overloads.append(int(key[key.find(":") + 1]))
-                usages.append(val.doc)
-        usage = "usage: " + "\n       ".join(usages)
-        overload_nb = rreplace(
-            ", ".join(str(x) for x in sorted(overloads)), ", ", " or "
+        preprocessor.command_vars["def"]["{}:{}".format(name, len(args))] = MacroBody(
+            name, args, literals, slots
         )
+        # a new command each time, so includes memoized with the old one
+        # are rendered again
+        preprocessor.commands[name] = Macro(preprocessor, name)
+        preprocessor.state_changed()
 
-        class Cmd(Command):
-            # overwrite defined command
-
-            def __call__(self, pre: Preprocessor, args_string: str) -> str:
-                """This is the actual command, parses arguments
-                and calls the correct overload"""
-                split = pre.split_args(args_string)
-                try:
-                    arguments = macro_parser.parse_args(split)
-                except argparse.ArgumentError:
-                    pre.send_error(
-                        "invalid-argument",
-                        "invalid argument for macro.\n{}".format(usage),
-                    )
-                if len(arguments.vars) not in overloads:
-                    pre.send_error(
-                        "invalid-argument",
-                        (
-                            "invalid number of arguments for macro.\nexpected {} got {}.\n"
-                            "{}"
-                        ).format(overload_nb, len(arguments.vars), usage),
-                    )
-                return str(
-                    pre.command_vars["def"]["{}:{}".format(name, len(arguments.vars))](
-                        pre, arguments.vars
-                    ),
-                )
-
-            doc = "Defined command for {} (expects {} arguments)\n{}".format(
-                name, overload_nb, usage
-            )
-
-        preprocessor.commands[name] = Cmd()
+    @staticmethod
+    def define_constants(
+        preprocessor: Preprocessor, defines: Mapping[str, str]
+    ) -> None:
+        """Defines many commands that take no arguments at once
+        (see defs.read_define_file to load them from a file).
+        Inputs:
+        - preprocessor - the object to which the commands are added
+        - defines: Mapping[str, str] - maps names to the text printed,
+        which is only parsed when called if it contains tokens.
+        Raises ValueError if a name isn't an identifier
+        """
+        commands = preprocessor.commands
+        for name, value in defines.items():
+            if not is_identifier(name):
+                raise ValueError('invalid define name "{}"'.format(name))
+            commands[name] = Constant(name, value)
+        preprocessor.state_changed()
 
     def __call__(self, preprocessor: Preprocessor, args_string: str) -> str:
         """the define command - inspired by the C preprocessor's define
@@ -342,6 +449,7 @@ class Cmd_Undef(Command):
                 'invalid identifier in undef: "{}"'.format(args_string),
             )
         undefined = False
+        preprocessor.state_changed()
         if ident in preprocessor.commands:
             del preprocessor.commands[ident]
             undefined = True
@@ -416,6 +524,7 @@ class Cmd_Deflist(Command):
                 return ""
 
         preprocessor.commands[ident] = Cmd()
+        preprocessor.state_changed()
         return ""
 
     doc = """
@@ -575,6 +684,7 @@ class Cmd_Label(Command):
 
 
 class Cmd_Paste(Command):
+    reads_state = True  # the clipboards
     parser = ArgumentParserNoExit(prog="cut", add_help=False)
     parser.add_argument("--verbatim", "-v", action="store_true")
     parser.add_argument("clipboard", nargs="?", default="")
@@ -584,7 +694,7 @@ class Cmd_Paste(Command):
         usage: paste [-v|--verbatim] [<clipboard_name>]"""
         split = pre.split_args(args)
         try:
-            arguments = self.parser.parse_args(split)
+            arguments = self.parser.bind(split)
         except argparse.ArgumentError:
             pre.send_error(
                 "invalid-argument",
@@ -614,7 +724,9 @@ class Cmd_Paste(Command):
 
 
 class Cmd_Date(Command):
-    def __call__(self, _: Preprocessor, args: str) -> str:
+    reads_state = True
+
+    def __call__(self, preprocessor: Preprocessor, args: str) -> str:
         """the date command, prints the current date.
         usage: date [format=YYYY-MM-DD]
         format specifies year with YYYY or YY, month with MM or M,
@@ -645,6 +757,7 @@ class Cmd_Date(Command):
         for _ignore, placeholder, repl in replacements:
             args = args.replace(placeholder, repl)
         date = datetime.now()
+        preprocessor.volatile = True
         return args.format(
             year=date.year,
             month=date.month,
@@ -678,27 +791,39 @@ class Cmd_Include(Command):
     )
 
     parser.add_argument("--verbatim", "-v", action="store_true")
+    parser.add_argument("--once", "-o", action="store_true")
     parser.add_argument("--begin", "-b", nargs="?", default=None)
     parser.add_argument("--end", "-e", nargs="?", default=None)
     parser.add_argument("file_path")
 
     def __call__(self, preprocessor: Preprocessor, args: str) -> str:
         """the include command
-        usage: include [-v|--verbatim] [-b|--begin <str>] [-e|--end <str>] file_path
+        usage: include [-v|--verbatim] [-o|--once] [-b|--begin <str>] [-e|--end <str>] file_path
         places the contents of the file at file_path
                 --verbatim specifies that the file should not be parsed, it is parsed by default
+                --once skips the file if it was already included (also the default
+                        when preprocessor.include_once is True)
                 --begin and --end can be used to set different preprocessor tokens
                         for the file being included"""
         split = preprocessor.split_args(args)
         try:
-            arguments = self.parser.parse_args(split)
+            arguments = self.parser.bind(split)
         except argparse.ArgumentError:
             preprocessor.send_error(
                 "invalid-argument",
-                "invalid argument.\nusage: include [-v|--verbatim] file_path",
+                "invalid argument.\nusage: include [-v|--verbatim] [-o|--once] file_path",
             )
         filepath = arguments.file_path
-        if not isfile(filepath):
+        file_cache = preprocessor.file_cache
+        if file_cache is not None:
+            resolved = file_cache.resolve(filepath, preprocessor.include_path)
+            if resolved is None:
+                preprocessor.send_error(
+                    "file-error", 'file not found "{}"'.format(arguments.file_path)
+                )
+            else:
+                filepath = resolved
+        elif not isfile(filepath):
             for include in preprocessor.include_path:
                 if isfile(join(include, filepath)):
                     filepath = join(include, filepath)
@@ -707,9 +832,44 @@ class Cmd_Include(Command):
                 preprocessor.send_error(
                     "file-error", 'file not found "{}"'.format(arguments.file_path)
                 )
+        # creating a file in the include path before filepath would change the output
+        for path in searched_paths(
+            arguments.file_path, preprocessor.include_path, filepath
+        ):
+            preprocessor.add_absent_dependency(path)
+        # files are identified by (device, inode) to detect repeated includes
+        included = preprocessor.command_vars.setdefault("include_once", set())
+        stack = preprocessor.command_vars.setdefault("include_stack", [])
+        try:
+            identity: Optional[Tuple[int, int]] = file_identity(filepath)
+        except OSError:
+            identity = None  # reported when reading the file
+        once = arguments.once or preprocessor.include_once
+        if once and preprocessor._render_logs:
+            # the output of the including file depends on what was included before
+            preprocessor._render_logs[-1].impure = True
+        if identity is not None:
+            if identity in included and once:
+                return ""
+            if not arguments.verbatim and identity in (ident for ident, _ in stack):
+                cycle = [name for _, name in stack] + [arguments.file_path]
+                preprocessor.send_error(
+                    "include-cycle",
+                    "include cycle detected:\n  {}".format("\n  includes ".join(cycle)),
+                )
+            included.add(identity)
+        # verbatim files placed directly in the document can be copied
+        # to the output without being read (see Preprocessor.defer_file)
+        defer = arguments.verbatim and preprocessor.can_defer()
         try:
-            with open(filepath, "r") as file:
-                contents = file.read()
+            if defer:
+                open(filepath, "rb").close()  # only check that it can be opened
+                contents = ""
+            elif file_cache is not None:
+                contents = file_cache.read(filepath)
+            else:
+                with open(filepath, "r") as file:
+                    contents = file.read()
         except FileNotFoundError:
             preprocessor.send_error(
                 "file-error", 'file not found "{}"'.format(arguments.file_path)
@@ -723,21 +883,103 @@ class Cmd_Include(Command):
             preprocessor.send_error(
                 "file-error", 'can\'t open file "{}"'.format(arguments.file_path)
             )
+        preprocessor.add_dependency(filepath)
+        if defer:
+            return preprocessor.defer_file(filepath)
+        if preprocessor._render_logs:
+            parent_log = preprocessor._render_logs[-1]
+            parent_log.files[filepath] = contents
+            if identity is not None:
+                parent_log.identities.add(identity)
         if not arguments.verbatim:
+            # files included with --once aren't memoized, as their output
+            # depends on the files included before
+            memo = None if file_cache is None or once else preprocessor.include_memo
+            if memo is not None:
+                key = (
+                    identity,
+                    contents,
+                    arguments.file_path,
+                    arguments.begin,
+                    arguments.end,
+                    preprocessor.token_begin,
+                    preprocessor.token_end,
+                    preprocessor.token_endblock,
+                    tuple(preprocessor.include_path),
+                    preprocessor._recursion_depth,
+                )
+                entry = memo.get(key, preprocessor)
+                if entry is not None and entry[0].identities.isdisjoint(
+                    ident for ident, _ in stack
+                ):
+                    return self.reuse(preprocessor, *entry)
             begin = preprocessor.token_begin
             end = preprocessor.token_end
             if arguments.begin is not None:
                 preprocessor.token_begin = arguments.begin
             if arguments.end is not None:
                 preprocessor.token_end = arguments.end
-            preprocessor.include_path.append(dirname(abspath(filepath)))
-            preprocessor.context.new(
-                FileDescriptor(arguments.file_path, contents), 0, "in included file"
-            )
-            contents = preprocessor.parse(contents)
-            preprocessor.context.pop()
-            preprocessor.token_begin = begin
-            preprocessor.token_end = end
+            # the file's directory is only searched while parsing the file
+            directory = dirname(abspath(filepath))
+            scoped = directory not in preprocessor.include_path
+            if scoped:
+                preprocessor.include_path.append(directory)
+            try:
+                preprocessor.context.new(
+                    FileDescriptor(arguments.file_path, contents), 0, "in included file"
+                )
+                preprocessor.load_file(contents)
+                stack.append((identity, arguments.file_path))
+                if memo is not None:
+                    snapshot = self.state(preprocessor)
+                    preprocessor._render_logs.append(RenderLog())
+                try:
+                    contents = preprocessor.parse(contents)
+                finally:
+                    stack.pop()
+                    if memo is not None:
+                        log = preprocessor._render_logs.pop()
+                if memo is not None:
+                    depth = preprocessor._recursion_depth
+                    labels = preprocessor.labels
+                    placed_labels = labels.height > depth + 1 and labels.top_level
+                    if not (log.impure or placed_labels):
+                        if self.state(preprocessor) == snapshot:
+                            memo.put(key, log, contents)
+                    if preprocessor._render_logs:
+                        preprocessor._render_logs[-1].merge(log)
+                preprocessor.context.pop()
+            finally:
+                if scoped:
+                    preprocessor.include_path.pop()
+                preprocessor.token_begin = begin
+                preprocessor.token_end = end
+        return contents
+
+    @staticmethod
+    def state(preprocessor: Preprocessor) -> Tuple[Any, ...]:
+        """the state an included file could change, other than labels.
+        Files which leave it unchanged can be memoized.
+        Changes to commands, blocks and command_vars are tracked by
+        preprocessor.generation, the rest is small"""
+        return (
+            preprocessor.generation,
+            preprocessor.final_actions.copy(),
+            preprocessor.token_begin,
+            preprocessor.token_end,
+            preprocessor.token_endblock,
+            preprocessor.include_path.copy(),
+        )
+
+    @staticmethod
+    def reuse(preprocessor: Preprocessor, log: RenderLog, contents: str) -> str:
+        """replays the effects of a memoized include: included files are
+        marked as included and added to the dependencies"""
+        preprocessor.command_vars["include_once"].update(log.identities)
+        for path in log.files:
+            preprocessor.add_dependency(path)
+        if preprocessor._render_logs:
+            preprocessor._render_logs[-1].merge(log)
         return contents
 
     doc = """
@@ -747,6 +989,7 @@ class Cmd_Include(Command):
         path can be absolute or relative to
         any path in include_path: [current_working_dir, input_file_dir, output_file_dir]
         paths can be added to include_path with the --include/-i/-I preprocessor option
+        within an included file, its directory is also part of include_path
 
         Options:
         -b --begin <string> specify the begin token ("{%")
@@ -754,6 +997,17 @@ class Cmd_Include(Command):
         -e --end   <string> specify the end token ("%}")
                             defaults to the same as current file
         -v --verbatim       when present, includes files as is, without parsing.
+                            With the --copy-verbatim preprocessor option,
+                            verbatim files placed directly in the document are
+                            copied byte for byte to the output file without
+                            being read, unless final actions need their contents
+        -o --once           skip the file if it was already included
+                            (default with the --include-once preprocessor option)
+
+        Including a file from itself (directly or not) raises an error
+        A file whose rendering doesn't change definitions, labels, clipboards or
+        final actions is only rendered once, the result is reused when it is
+        included again with the same commands
         """
 
 
@@ -763,6 +1017,8 @@ class Cmd_Include(Command):
 
 
 class Cmd_FileSize(Command):
+    reads_state = True
+
     def __call__(self, preprocessor: Preprocessor, args: str) -> str:
         """the filesize command - prints the file size of its argument"""
         file = args.strip()
@@ -772,7 +1028,9 @@ class Cmd_FileSize(Command):
                 "the filesize command takes one mandatory arguement 'filename'",
             )
         try:
-            return str(getsize(file))
+            size = getsize(file)
+            preprocessor.add_dependency(file)
+            return str(size)
         except FileNotFoundError:
             preprocessor.send_error("file-error", 'file not found "{}"'.format(file))
         except PermissionError:
@@ -804,6 +1062,8 @@ def pretty_size(value: int) -> str:
 
 
 class Cmd_FilePrettySize(Command):
+    reads_state = True
+
     def __call__(self, preprocessor: Preprocessor, args: str) -> str:
         """the fileprettysize command - pretty prints the file size of its argument"""
         file = args.strip()
@@ -813,7 +1073,9 @@ class Cmd_FilePrettySize(Command):
                 "the fileprettysize command takes one mandatory arguement 'filename'",
             )
         try:
-            return pretty_size(getsize(file))
+            size = getsize(file)
+            preprocessor.add_dependency(file)
+            return pretty_size(size)
         except FileNotFoundError:
             preprocessor.send_error("file-error", 'file not found "{}"'.format(file))
         except PermissionError:
@@ -127,9 +127,9 @@ def simple_condition_evaluator(preproc: Preprocessor, tokens: List[str]) -> bool
         return not (tokens[0] in ["false", "0", ""])
     if len_tok == 2:
         if tokens[0] == "def":
-            return tokens[1] in preproc.commands or tokens[1] in preproc.blocks
+            return preproc.lookup(tokens[1]) != (None, None)
         if tokens[0] == "ndef":
-            return not (tokens[1] in preproc.commands or tokens[1] in preproc.blocks)
+            return preproc.lookup(tokens[1]) == (None, None)
     if len_tok == 3:
         if tokens[1] == "==":
             return tokens[0] == tokens[2]
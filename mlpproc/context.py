@@ -18,7 +18,6 @@ It contains:
     remove them with .pop()
     .trace() shows a trace leading to the topmost context
 """
-
 import re
 from typing import List, Optional, Tuple
 
@@ -28,16 +27,28 @@ class FileDescriptor:
     contains:
     - file name
     - file initial contents
-    - line breaks"""
+    - line breaks
+    - line and char offsets, when contents is only a part of the file
+      starting at line line_offset + 1 and char char_offset of that line"""
 
     filename: str
     contents: str
+    line_offset: int
+    char_offset: int
     _line_breaks: List[int]
 
-    def __init__(self: "FileDescriptor", filename: str, contents: str) -> None:
+    def __init__(
+        self: "FileDescriptor",
+        filename: str,
+        contents: str,
+        line_offset: int = 0,
+        char_offset: int = 0,
+    ) -> None:
         """initialises the FileDescriptor element and computes linebreaks"""
         self.filename = filename
         self.contents = contents
+        self.line_offset = line_offset
+        self.char_offset = char_offset
         self._line_breaks = self.line_breaks_from_str(contents)
 
     @staticmethod
@@ -58,7 +69,9 @@ class FileDescriptor:
                 line_nb += 1
                 if pos - line_end < pos - closest_line_end:
                     closest_line_end = line_end
-        return line_nb, pos - closest_line_end
+        if line_nb == 1:
+            return 1 + self.line_offset, pos + self.char_offset
+        return line_nb + self.line_offset, pos - closest_line_end
 
 
 class ContextElement:
@@ -113,8 +126,7 @@ class ContextElement:
         if desc is None:
             desc = self.description
         copy = ContextElement(self.file, desc, position, False)
-        for pos, value in self._dilatations:
-            copy.add_dilatation(pos, value)
+        copy._dilatations = self._dilatations.copy()
         return copy
 
 
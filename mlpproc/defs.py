@@ -3,29 +3,39 @@ This module contains various definitions and constants used by the preprocessor
 namely:
 - class ArgumentParserNoExit(argparse.ArgumentParser)
   which raises an error rather than exit.
+- class ArgumentBinder, a fast path for simple calls to ArgumentParserNoExit
 - class Position to represent position to command
 - enum WarningMode to configure the Preprocessor
 - function trim to pretty-print docstrings
 - function process_string to process read string ("\\n" into newline)
+- functions parse_defines and read_define_file to read defines
+  from JSON, .env or key=value files
 - functions is_integer or to_integer to get ints from strings
 - function get_identifier_name to find the first identifier in a string
+- function is_identifier to check that a string is a command name
+- the REGEX_* constants (defined in patterns)
 """
 
 import argparse
 import enum
+import json
 import re
-from typing import NoReturn, Tuple
+from typing import Any, Dict, Iterable, List, NoReturn, Optional, Tuple
+
+from .patterns import (  # noqa: F401
+    REGEX_IDENTIFIER,
+    REGEX_IDENTIFIER_BEGIN,
+    REGEX_IDENTIFIER_END,
+    REGEX_IDENTIFIER_WRAPPED,
+    REGEX_INTEGER,
+    REGEX_STRING,
+    PatternKind,
+    get_pattern,
+)
 
 PREPROCESSOR_NAME = "mlpp"
 PREPROCESSOR_VERSION = "1.0.3"
 
-REGEX_IDENTIFIER: str = "[_a-zA-Z][_a-zA-Z0-9]*"
-REGEX_IDENTIFIER_WRAPPED: str = "(^|(?<=([^_a-zA-Z0-9]))){}((?=([^_a-zA-Z0-9]))|$)"
-REGEX_IDENTIFIER_END: str = "$|[^_a-zA-Z0-9]"
-REGEX_IDENTIFIER_BEGIN: str = "^|[^_a-zA-Z]"
-REGEX_STRING: str = '""|".*?[^\\\\]"'
-REGEX_INTEGER: str = r"-?\ *[0-9]+(?:[_0-9]*[0-9])?"
-
 
 class Position:
     """represents a position to a command
@@ -144,29 +154,230 @@ def process_string(string: str) -> str:
     return string
 
 
+def parse_defines(text: str, use_json: bool = False) -> Dict[str, str]:
+    """Reads defines from text, returns a dict mapping names to values.
+    - if use_json, text is a JSON object. Strings are used as is,
+      null as the empty string and other values as their JSON text
+    - otherwise it has one "<name>=<value>" or "<name>" per line, like .env files:
+      empty lines and lines starting with # are ignored, names can be preceded
+      by "export " and values are stripped. Values in double quotes are processed
+      with process_string, values in single quotes are used as is.
+    Raises ValueError on syntax errors and invalid names"""
+    defines: Dict[str, str] = dict()
+    if use_json:
+        try:
+            values = json.loads(text)
+        except json.JSONDecodeError as error:
+            raise ValueError("invalid JSON: {}".format(error)) from error
+        if not isinstance(values, dict):
+            raise ValueError("expected a JSON object")
+        for name, value in values.items():
+            if not is_identifier(name):
+                raise ValueError('invalid define name "{}"'.format(name))
+            if value is None:
+                value = ""
+            elif not isinstance(value, str):
+                value = json.dumps(value)
+            defines[name] = value
+        return defines
+    for line_number, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if line == "" or line[0] == "#":
+            continue
+        if line.startswith("export "):
+            line = line[7:]
+        name, _, value = line.partition("=")
+        name = name.strip()
+        if not is_identifier(name):
+            raise ValueError(
+                'line {}: invalid define name "{}"'.format(line_number, name)
+            )
+        value = value.strip()
+        if len(value) >= 2 and value[0] in "\"'" and value[-1] == value[0]:
+            value = process_string(value[1:-1]) if value[0] == '"' else value[1:-1]
+        defines[name] = value
+    return defines
+
+
+def read_define_file(path: str) -> Dict[str, str]:
+    """Reads defines from the file at path, see parse_defines.
+    The file is read as JSON if its name ends with ".json"
+    or its first non-whitespace character is "{".
+    Raises OSError if it can't be read, ValueError if it is invalid"""
+    with open(path, encoding="utf-8") as file:
+        text = file.read()
+    use_json = path.endswith(".json") or text.lstrip().startswith("{")
+    return parse_defines(text, use_json)
+
+
+class ArgumentBinder:
+    """Binds split arguments to the actions of an argument parser
+    without going through argparse, for simple command lines:
+    - options are exactly one of their option strings (no prefixes,
+      no "--opt=value", no grouped short flags)
+    - options are flags (store_true) or take one or an optional value
+    - positionals take one, an optional or any number of words,
+      and aren't separated by options
+    bind() returns None on other command lines and on errors,
+    they should then be parsed by argparse"""
+
+    __slots__ = ("size", "defaults", "flags", "options", "positionals")
+
+    size: int
+    defaults: Dict[str, Any]
+    flags: Dict[str, str]
+    options: Dict[str, Tuple[str, Any, Any, Any]]
+    positionals: Optional[List[Tuple[str, Any, Any]]]
+
+    def __init__(self: "ArgumentBinder", actions: List[argparse.Action]) -> None:
+        self.size = len(actions)
+        self.defaults = dict()
+        self.flags = dict()
+        self.options = dict()
+        self.positionals = list()
+        for action in actions:
+            self.defaults[action.dest] = action.default
+            if action.choices is not None or (
+                isinstance(action.default, str) and action.type is not None
+            ):
+                self.positionals = None
+            elif isinstance(action, argparse._StoreTrueAction):
+                for option in action.option_strings:
+                    self.flags[option] = action.dest
+            elif not isinstance(action, argparse._StoreAction):
+                self.positionals = None
+            elif action.option_strings:
+                if action.nargs not in (None, "?"):
+                    self.positionals = None
+                for option in action.option_strings:
+                    self.options[option] = (
+                        action.dest,
+                        action.nargs,
+                        action.type,
+                        action.const,
+                    )
+            elif action.nargs in (None, "?", "*") and self.positionals is not None:
+                self.positionals.append((action.dest, action.nargs, action.type))
+            else:
+                self.positionals = None
+
+    def bind(self: "ArgumentBinder", words: List[str]) -> Optional[Dict[str, Any]]:
+        """returns the values of all arguments, like vars(parser.parse_args(words)),
+        or None if words must be parsed by argparse"""
+        if self.positionals is None:
+            return None
+        values = self.defaults.copy()
+        start = -1  # positional words are words[start:end]
+        end = -1
+        i = 0
+        len_words = len(words)
+        while i < len_words:
+            word = words[i]
+            if len(word) < 2 or word[0] != "-":
+                if start == -1:
+                    start = i
+                elif end != -1:
+                    return None  # positionals separated by options
+                i += 1
+                continue
+            if start != -1 and end == -1:
+                end = i
+            if word in self.flags:
+                values[self.flags[word]] = True
+            elif word in self.options:
+                dest, nargs, kind, value = self.options[word]
+                if i + 1 < len_words and words[i + 1][:1] != "-":
+                    i += 1
+                    value = words[i]
+                    if kind is not None:
+                        try:
+                            value = kind(value)
+                        except (TypeError, ValueError):
+                            return None
+                elif nargs != "?" or i + 1 < len_words:
+                    return None
+                values[dest] = value
+            else:
+                return None
+            i += 1
+        if start == -1:
+            positional_words: List[str] = []
+        else:
+            positional_words = words[start : len_words if end == -1 else end]
+        return self._bind_positionals(positional_words, values)
+
+    def _bind_positionals(
+        self: "ArgumentBinder", words: List[str], values: Dict[str, Any]
+    ) -> Optional[Dict[str, Any]]:
+        """assigns words to positionals, in order, optional ones
+        only taking words left by the following required ones"""
+        assert self.positionals is not None
+        required = sum(1 for _, nargs, _ in self.positionals if nargs is None)
+        index = 0
+        for dest, nargs, kind in self.positionals:
+            available = len(words) - index
+            if nargs is None:
+                required -= 1
+                if available < 1:
+                    return None
+                taken = words[index : index + 1]
+            elif nargs == "?":
+                taken = words[index : index + 1] if available > required else []
+            else:
+                taken = words[index : index + max(available - required, 0)]
+            index += len(taken)
+            if kind is not None:
+                try:
+                    taken = [kind(word) for word in taken]
+                except (TypeError, ValueError):
+                    return None
+            if nargs is None or (nargs == "?" and taken):
+                values[dest] = taken[0]
+            elif nargs == "*" and (taken or values[dest] is None):
+                values[dest] = taken
+        if index != len(words):
+            return None
+        return values
+
+
 class ArgumentParserNoExit(argparse.ArgumentParser):
     """subclass of argparse.ArgumentParser which
     raises an error rather than exiting when parsing fails"""
 
+    _binder: Optional[ArgumentBinder] = None
+
     def error(self, message: str) -> NoReturn:
         raise argparse.ArgumentError(None, message)
 
+    def bind(self, args: Iterable[str]) -> argparse.Namespace:
+        """same as parse_args(args), but simple command lines are bound by
+        an ArgumentBinder, built on the first call and reused by the next ones"""
+        args = list(args)
+        if self._binder is None or self._binder.size != len(self._actions):
+            self._binder = ArgumentBinder(self._actions)
+        values = self._binder.bind(args)
+        if values is None:
+            return self.parse_args(args)
+        return argparse.Namespace(**values)
+
 
 def get_identifier_name(string: str) -> Tuple[str, str, int]:
     """finds the first identifier in string:
     Returns:
             tuple str, str, int - identifier, rest_of_string, start_of_rest_of_string
             returns ("","", -1) if None found"""
-    match = re.match(
-        r"\s*({})({}.*$)".format(REGEX_IDENTIFIER, REGEX_IDENTIFIER_END),
-        string,
-        re.DOTALL,
-    )
+    match = get_pattern(PatternKind.IDENTIFIER, flags=re.DOTALL).match(string)
     if match is None:
         return ("", "", -1)
     return match.group(1), match.group(2), match.start(2)
 
 
+def is_identifier(string: str) -> bool:
+    """returns True if string is a valid command name (see REGEX_IDENTIFIER),
+    unlike str.isidentifier, non ascii letters aren't allowed"""
+    return re.fullmatch(REGEX_IDENTIFIER, string) is not None
+
+
 def is_integer(string: str) -> bool:
     """returns True if string can safely be converted
     to a integer with to_integer(string)"""
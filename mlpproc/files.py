@@ -0,0 +1,446 @@
+"""This module implements the cache of included files
+
+It contains:
+
+- class FileCache
+    contents of files read by include and paths resolved in the
+    include path, shared between all documents processed by a Preprocessor
+    (or by several preprocessors in batch mode).
+    Files can be prefetched: read ahead of time on a thread pool
+
+- class FileCacheInfo
+    statistics returned by FileCache.cache_info
+
+- function searched_paths
+    the paths checked in the include path before finding a file
+
+- function file_identity
+    identifies a file independently of the path used to access it
+
+- function write_if_changed
+    writes a file atomically, unless it already has the right contents
+
+- function write_spliced
+    writes text interleaved with the contents of other files,
+    which are copied by the kernel (see copy_file)
+
+- function dependency_rule
+    formats the files a document depends on as a Makefile rule
+"""
+import errno
+import locale
+import os
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from os.path import abspath, dirname, isfile, join
+from tempfile import mkstemp
+from typing import Dict, Iterable, List, MutableMapping, NamedTuple, Optional, Tuple
+
+# default maximum number of characters in a FileCache
+CACHE_MAXSIZE = 64 * 1024 * 1024
+# (st_mtime_ns, st_size) of a file
+Signature = Tuple[int, int]
+# (name, include path) of a resolution
+ResolutionKey = Tuple[str, Tuple[str, ...]]
+
+
+def find_file(name: str, include_path: Iterable[str]) -> Optional[str]:
+    """returns name if it is a file, else the first join(directory, name)
+    that is a file, directories being searched in include_path order.
+    returns None if no file is found"""
+    if isfile(name):
+        return name
+    for directory in include_path:
+        if isfile(join(directory, name)):
+            return join(directory, name)
+    return None
+
+
+def searched_paths(
+    name: str, include_path: Iterable[str], found: Optional[str]
+) -> List[str]:
+    """returns the paths find_file(name, include_path) checked before
+    returning found (all the paths it checks if found is None)"""
+    paths = [name] + [join(directory, name) for directory in include_path]
+    if found in paths:
+        return paths[: paths.index(found)]
+    return paths
+
+
+def fetch_file(
+    name: str, include_path: Iterable[str]
+) -> Optional[Tuple[str, Signature, str]]:
+    """finds and reads a file, returns (path, signature, contents),
+    None if it isn't found or can't be read.
+    Used by prefetching threads, so it doesn't touch any shared state"""
+    path = find_file(name, include_path)
+    if path is None:
+        return None
+    try:
+        stat = os.stat(path)
+        with open(path, "r") as file:
+            return path, (stat.st_mtime_ns, stat.st_size), file.read()
+    except (OSError, ValueError):  # ValueError: UnicodeDecodeError
+        return None
+
+
+class FileCacheInfo(NamedTuple):
+    """Statistics of a FileCache"""
+
+    hits: int
+    misses: int
+    evictions: int
+    maxsize: int
+    currsize: int  # total length of the cached contents
+
+
+class FileCache:
+    """Contents of files and include path resolutions
+
+    Contents are keyed by absolute path and stored with the file's
+    (mtime, size), they are read again if these change, so documents
+    can include files written earlier in the same batch.
+    At most maxsize characters are kept, least recently used files are
+    evicted first. Contents can also be stored in a shared mapping
+    (like a multiprocessing.Manager().dict()) to share them between processes.
+    Each cache adds at most shared_maxsize characters (default maxsize) to
+    the shared mapping, removing the least recently used files it added first.
+
+    Resolutions are keyed by (name, include path), whether a file was found
+    or not. forget(path) should be called when creating a file, as it may
+    shadow a previous resolution (or resolve a missing one), and
+    forget_resolutions() when files may have been created by others.
+
+    prefetch(names, include_path) resolves and reads files on a pool of
+    prefetch_workers threads. The threads don't modify the cache, their results
+    are added to it when the files are resolved or when prefetch is called again.
+    At most max_prefetches files are pending, others aren't prefetched.
+    Call close() to stop the threads."""
+
+    maxsize: int
+    shared: Optional[MutableMapping[str, Tuple[Signature, str]]]
+    shared_maxsize: int
+    _shared_size: int
+    _shared_sizes: "OrderedDict[str, int]"
+    hits: int
+    misses: int
+    evictions: int
+    _size: int
+    _contents: "OrderedDict[str, Tuple[Signature, str]]"
+    prefetch_workers: int
+    max_prefetches: int
+    _resolved: Dict[ResolutionKey, Optional[str]]
+    _pending: "Dict[ResolutionKey, Future[Optional[Tuple[str, Signature, str]]]]"
+    _executor: Optional[ThreadPoolExecutor]
+
+    def __init__(
+        self: "FileCache",
+        maxsize: int = CACHE_MAXSIZE,
+        shared: Optional[MutableMapping[str, Tuple[Signature, str]]] = None,
+        prefetch_workers: int = 8,
+        shared_maxsize: Optional[int] = None,
+        max_prefetches: int = 64,
+    ) -> None:
+        self.maxsize = maxsize
+        self.shared = shared
+        self.shared_maxsize = maxsize if shared_maxsize is None else shared_maxsize
+        self._shared_size = 0
+        self._shared_sizes = OrderedDict()
+        self.prefetch_workers = prefetch_workers
+        self.max_prefetches = max_prefetches
+        self._pending = dict()
+        self._executor = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = 0
+        self._contents = OrderedDict()
+        self._resolved = dict()
+
+    def resolve(self: "FileCache", name: str, include_path: List[str]) -> Optional[str]:
+        """returns the path of the file name: name itself if it is a file,
+        else the first join(directory, name) that is a file,
+        directories being searched in include_path order.
+        returns None if no file is found"""
+        key = (name, tuple(include_path))
+        if key in self._pending:
+            self._collect(key)
+        if key in self._resolved:
+            path = self._resolved[key]
+            # a cached file may have been removed since
+            if path is None or isfile(path):
+                return path
+        path = find_file(name, include_path)
+        self._resolved[key] = path
+        return path
+
+    def prefetch(
+        self: "FileCache", names: Iterable[str], include_path: List[str]
+    ) -> None:
+        """starts resolving and reading the files names in the background,
+        resolve(name, include_path) then returns when they are read"""
+        # finished prefetches are moved to the cache, where their size is bounded
+        for key in [key for key, future in self._pending.items() if future.done()]:
+            self._collect(key)
+        directories = tuple(include_path)
+        for name in names:
+            key = (name, directories)
+            if key in self._pending or key in self._resolved:
+                continue
+            if len(self._pending) >= self.max_prefetches:
+                break
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.prefetch_workers)
+            self._pending[key] = self._executor.submit(fetch_file, name, directories)
+
+    def _collect(self: "FileCache", key: ResolutionKey) -> None:
+        """waits for the prefetch of key and adds its result to the cache"""
+        loaded = self._pending.pop(key).result()
+        if loaded is not None:
+            found, signature, contents = loaded
+            self._add(abspath(found), signature, contents)
+            self._resolved[key] = found
+
+    def close(self: "FileCache") -> None:
+        """stops the prefetching threads, dropping unfinished prefetches"""
+        if self._executor is not None:
+            for future in self._pending.values():
+                future.cancel()
+            self._pending.clear()
+            self._executor.shutdown()
+            self._executor = None
+
+    def _store(self: "FileCache", key: str, signature: Signature, text: str) -> None:
+        """adds contents to the cache, evicting old ones if needed"""
+        self._remove(key)
+        if len(text) > self.maxsize:
+            return
+        self._contents[key] = (signature, text)
+        self._size += len(text)
+        while self._size > self.maxsize:
+            _, (_, evicted) = self._contents.popitem(last=False)
+            self._size -= len(evicted)
+            self.evictions += 1
+
+    def _remove(self: "FileCache", key: str) -> None:
+        entry = self._contents.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[1])
+
+    def read(self: "FileCache", path: str) -> str:
+        """returns the contents of the file at path,
+        raises the same errors as open() and read()"""
+        key = abspath(path)
+        stat = os.stat(key)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        entry = self._contents.get(key)
+        if entry is not None and entry[0] == signature:
+            self.hits += 1
+            self._contents.move_to_end(key)
+            return entry[1]
+        if self.shared is not None:
+            entry = self.shared.get(key)
+            if entry is not None and tuple(entry[0]) == signature:
+                self.hits += 1
+                if key in self._shared_sizes:
+                    self._shared_sizes.move_to_end(key)
+                self._store(key, signature, entry[1])
+                return entry[1]
+        self.misses += 1
+        with open(key, "r") as file:
+            contents = file.read()
+        self._add(key, signature, contents)
+        return contents
+
+    def _add(self: "FileCache", key: str, signature: Signature, text: str) -> None:
+        """adds contents read from disk to the cache and the shared mapping"""
+        self._store(key, signature, text)
+        if self.shared is not None and len(text) <= self.shared_maxsize:
+            self.shared[key] = (signature, text)
+            self._unshare(key)
+            self._shared_sizes[key] = len(text)
+            self._shared_size += len(text)
+            while self._shared_size > self.shared_maxsize:
+                evicted, size = self._shared_sizes.popitem(last=False)
+                self._shared_size -= size
+                self.shared.pop(evicted, None)
+
+    def _unshare(self: "FileCache", key: str) -> None:
+        """forgets that key was added to the shared mapping"""
+        size = self._shared_sizes.pop(key, None)
+        if size is not None:
+            self._shared_size -= size
+
+    def cache_info(self: "FileCache") -> FileCacheInfo:
+        """returns hits, misses, evictions, max size and current size"""
+        return FileCacheInfo(
+            self.hits, self.misses, self.evictions, self.maxsize, self._size
+        )
+
+    def forget(self: "FileCache", path: str) -> None:
+        """signals that the file at path was written"""
+        self._remove(abspath(path))
+        if self.shared is not None:
+            self.shared.pop(abspath(path), None)
+            self._unshare(abspath(path))
+        self.forget_resolutions()
+
+    def forget_resolutions(self: "FileCache") -> None:
+        """drops the include path resolutions, so that files
+        created since are found (contents are still cached)"""
+        self._resolved.clear()
+
+
+def file_identity(path: str) -> Tuple[int, int]:
+    """returns (device, inode) of the file, raises OSError if it doesn't exist.
+    Files with the same identity are the same, even through links.
+    Falls back to a hash of the real path when inodes aren't supported"""
+    stat = os.stat(path)
+    if stat.st_ino == 0:
+        return stat.st_dev, hash(os.path.normcase(os.path.realpath(path)))
+    return stat.st_dev, stat.st_ino
+
+
+def same_contents(path: str, data: bytes, block_size: int = 1 << 16) -> bool:
+    """returns True if the file at path contains exactly data.
+    Compares sizes first, then reads the file by blocks"""
+    try:
+        if os.stat(path).st_size != len(data):
+            return False
+        with open(path, "rb") as file:
+            pos = 0
+            while pos < len(data):
+                block = file.read(block_size)
+                if not block or data[pos : pos + len(block)] != block:
+                    return False
+                pos += len(block)
+            return file.read(1) == b""
+    except OSError:
+        return False
+
+
+def encode_text(text: str) -> bytes:
+    """encodes text like writing it to a file opened with open(path, "w") would"""
+    if os.linesep != "\n":
+        text = text.replace("\n", os.linesep)
+    return text.encode(locale.getpreferredencoding(False))
+
+
+def write_if_changed(path: str, text: str) -> bool:
+    """writes text to the file at path, like open(path, "w").write(text),
+    but leaves the file untouched (and its modification time unchanged)
+    if it already contains text. Otherwise, text is written to a
+    temporary file which replaces path, so path is never partially written.
+    Returns True if the file was written.
+    Raises OSError if the file can't be written"""
+    data = encode_text(text)
+    if same_contents(path, data):
+        return False
+    try:
+        mode = os.stat(path).st_mode & 0o7777
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+    handle, tmp_path = mkstemp(dir=dirname(abspath(path)), prefix=".tmp-")
+    try:
+        with os.fdopen(handle, "wb") as file:
+            file.write(data)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except OSError:
+        os.remove(tmp_path)
+        raise
+    return True
+
+
+# errors on which copy_file falls back to a more portable copy method
+COPY_FALLBACK_ERRORS = {
+    errno.ENOSYS,
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+    errno.EBADF,
+}
+
+
+def _copy_file_range(in_fd: int, out_fd: int, count: int) -> int:
+    copy_file_range = getattr(os, "copy_file_range", None)  # linux, python 3.8+
+    if copy_file_range is None:
+        raise OSError(errno.ENOSYS, "copy_file_range is not available")
+    return int(copy_file_range(in_fd, out_fd, count))
+
+
+def _sendfile(in_fd: int, out_fd: int, count: int) -> int:
+    if not hasattr(os, "sendfile"):
+        raise OSError(errno.ENOSYS, "sendfile is not available")
+    offset = os.lseek(in_fd, 0, os.SEEK_CUR)
+    sent = os.sendfile(out_fd, in_fd, offset, count)
+    os.lseek(in_fd, offset + sent, os.SEEK_SET)
+    return sent
+
+
+def _write_all(fd: int, data: bytes) -> None:
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view) :]
+
+
+def copy_file(path: str, fd: int, chunk_size: int = 1 << 24) -> None:
+    """appends the contents of the file at path to the file descriptor fd.
+    The kernel copies the data when possible (with copy_file_range, or sendfile),
+    so it isn't read into memory. The file is copied as is, without decoding
+    it or translating line endings"""
+    methods = [_copy_file_range, _sendfile]
+    with open(path, "rb") as file:
+        in_fd = file.fileno()
+        while True:
+            if methods:
+                try:
+                    copied = methods[0](in_fd, fd, chunk_size)
+                except OSError as error:
+                    if error.errno not in COPY_FALLBACK_ERRORS:
+                        raise
+                    methods.pop(0)
+                    continue
+            else:
+                data = os.read(in_fd, chunk_size)
+                _write_all(fd, data)
+                copied = len(data)
+            if copied == 0:
+                return
+
+
+def write_spliced(path: str, parts: List[str]) -> None:
+    """writes a file from parts, a list alternating text and paths
+    of files to copy, as returned by Preprocessor.split_deferred.
+    Text is encoded like open(path, "w") would, files are copied with copy_file.
+    Raises OSError if a file can't be read or written"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        for i, part in enumerate(parts):
+            if i % 2:
+                copy_file(part, fd)
+            elif part:
+                _write_all(fd, encode_text(part))
+    finally:
+        os.close(fd)
+
+
+def make_escape(path: str) -> str:
+    """escapes path for use in a Makefile rule"""
+    return path.replace("$", "$$").replace("#", "\\#").replace(" ", "\\ ")
+
+
+def dependency_rule(target: str, dependencies: List[str], phony: bool = False) -> str:
+    """returns a Makefile rule "target: dependencies..." like gcc -M would.
+    if phony, adds an empty rule for each dependency but the first
+    so make doesn't fail when one is deleted"""
+    lines = [make_escape(target) + ":"]
+    for dependency in dependencies:
+        lines.append(make_escape(dependency))
+    rule = " \\\n  ".join(lines) + "\n"
+    if phony:
+        for dependency in dependencies[1:]:
+            rule += "\n{}:\n".format(make_escape(dependency))
+    return rule
@@ -4,10 +4,12 @@ and the commands that trigger them
 """
 import argparse
 import re
-from typing import Optional
+from typing import Optional, Pattern
 
-from .defs import REGEX_IDENTIFIER_WRAPPED, ArgumentParserNoExit
-from .preprocessor import Command, Preprocessor
+from .buffer import TextOrBuffer
+from .defs import ArgumentParserNoExit
+from .patterns import PatternKind, get_pattern
+from .preprocessor import Command, Preprocessor, edits_buffer
 
 
 class FinalActionCommand(Command):
@@ -34,29 +36,25 @@ class FinalActionCommand(Command):
 
 def final_action_replace(
     preprocessor: Preprocessor,
-    string: str,
-    pattern: str,
+    string: TextOrBuffer,
+    pattern: Pattern[str],
     replacement: str,
-    flags: re.RegexFlag,
     count: int = 0,
-) -> str:
-    """same as string = re.sub(pattern, replacement, string)
-    but uses preprocessor string_replace to offset labels correctly"""
-    matches = []
-    for re_match in re.finditer(pattern, string, flags=flags):
-        matches.append((re_match.start(), re_match.end(), re_match.group()))
+) -> TextOrBuffer:
+    """same as string = pattern.sub(replacement, string, count)
+    but uses preprocessor string_replace to offset labels correctly
+    TextBuffers are edited in place"""
+    offset = 0
     replaced_nb = 0
-    while matches:
-        match = matches[0]
-        local_repl = re.sub(pattern, replacement, match[2], flags=flags)
-        string = preprocessor.replace_string(
-            match[0], match[1], string, local_repl, matches
-        )
+    for re_match in pattern.finditer(str(string)):
+        local_repl = re_match.expand(replacement)
+        start = re_match.start() + offset
+        end = re_match.end() + offset
+        string = preprocessor.replace_string(start, end, string, local_repl, [])
+        offset += len(local_repl) - (end - start)
         replaced_nb += 1
         if replaced_nb == count:
-            return string
-        if matches and match == matches[0]:
-            del matches[0]
+            break
     return string
 
 
@@ -66,11 +64,15 @@ def final_action_replace(
 
 
 class Cmd_StripEmptyLines(FinalActionCommand):
-    def final_action(self, preprocessor: Preprocessor, string: str) -> str:
+    @edits_buffer
+    def final_action(
+        self, preprocessor: Preprocessor, string: TextOrBuffer
+    ) -> TextOrBuffer:
         """final action to remove empty lines (containing whitespace only) from the text"""
-        return final_action_replace(
-            preprocessor, string, r"\n\s*\n", "\n", preprocessor.re_flags
+        pattern = get_pattern(
+            PatternKind.REGEX, name=r"\n\s*\n", flags=preprocessor.re_flags
         )
+        return final_action_replace(preprocessor, string, pattern, "\n")
 
     doc = """
         Removes empty lines (lines containing only spaces)
@@ -78,9 +80,13 @@ class Cmd_StripEmptyLines(FinalActionCommand):
 
 
 class Cmd_StripLeadingWhitespace(FinalActionCommand):
-    def final_action(self, preprocessor: Preprocessor, string: str) -> str:
+    @edits_buffer
+    def final_action(
+        self, preprocessor: Preprocessor, string: TextOrBuffer
+    ) -> TextOrBuffer:
         """final action to remove leading whitespace (indent) from string"""
-        return final_action_replace(preprocessor, string, "^[ \t]+", "", re.MULTILINE)
+        pattern = get_pattern(PatternKind.REGEX, name="^[ \t]+", flags=re.MULTILINE)
+        return final_action_replace(preprocessor, string, pattern, "")
 
     doc = """
         Removes leading whitespace (indent)
@@ -88,9 +94,13 @@ class Cmd_StripLeadingWhitespace(FinalActionCommand):
 
 
 class Cmd_StripTrailingWhitespace(FinalActionCommand):
-    def final_action(self, preprocessor: Preprocessor, string: str) -> str:
+    @edits_buffer
+    def final_action(
+        self, preprocessor: Preprocessor, string: TextOrBuffer
+    ) -> TextOrBuffer:
         """final action to remove trailing whitespace (indent) from string"""
-        return final_action_replace(preprocessor, string, "[ \t]+$", "", re.MULTILINE)
+        pattern = get_pattern(PatternKind.REGEX, name="[ \t]+$", flags=re.MULTILINE)
+        return final_action_replace(preprocessor, string, pattern, "")
 
     doc = """
         Removes trailing whitespace
@@ -98,11 +108,16 @@ class Cmd_StripTrailingWhitespace(FinalActionCommand):
 
 
 class Cmd_FixLastLine(FinalActionCommand):
-    def final_action(self, preprocessor: Preprocessor, string: str) -> str:
+    @edits_buffer
+    def final_action(
+        self, preprocessor: Preprocessor, string: TextOrBuffer
+    ) -> TextOrBuffer:
         """final action to ensures file ends with an empty line if
         it is not empty"""
         if string and string[-1] != "\n":
-            string += "\n"
+            string = preprocessor.replace_string(
+                len(string), len(string), string, "\n", []
+            )
         else:
             ii = len(string) - 2
             while ii >= 0 and string[ii] == "\n":
@@ -117,13 +132,16 @@ class Cmd_FixLastLine(FinalActionCommand):
 
 
 class Cmd_FixFirstLine(FinalActionCommand):
-    def final_action(self, preprocessor: Preprocessor, string: str) -> str:
+    @edits_buffer
+    def final_action(
+        self, preprocessor: Preprocessor, string: TextOrBuffer
+    ) -> TextOrBuffer:
         """final action to ensures file starts with a non-empty
         non-whitespace line (if it is not empty)"""
-        while string != "":
-            pos = string.find("\n")
+        while len(string) != 0:
+            pos = str(string).find("\n")
             if pos == -1:
-                if string.isspace():
+                if str(string).isspace():
                     return preprocessor.replace_string(0, len(string), string, "", [])
                 return string
             if string[: pos + 1].isspace():
@@ -188,7 +206,7 @@ class Cmd_Replace(Command):
         """
         split = preprocessor.split_args(args)
         try:
-            arguments = self.parser.parse_args(split)
+            arguments = self.parser.bind(split)
         except argparse.ArgumentError:
             preprocessor.send_error(
                 "invalid-argument",
@@ -197,6 +215,7 @@ class Cmd_Replace(Command):
                 "               [-c|--count <number>] pattern replacement [text]",
             )
         flags = re.MULTILINE
+        kind = PatternKind.REGEX
         pattern: str = arguments.pattern
         repl = arguments.replacement
         if arguments.ignore_case:
@@ -207,11 +226,11 @@ class Cmd_Replace(Command):
                     "invalid-argument",
                     "incompatible arguments : --regex and --whole-word",
                 )
+        elif arguments.whole_word:
+            kind = PatternKind.WHOLE_WORD
+            repl = "\\1{}\\3".format(repl)
         else:
             pattern = re.escape(pattern)
-            if arguments.whole_word:
-                pattern = REGEX_IDENTIFIER_WRAPPED.format(pattern)
-                repl = "\\1{}\\3".format(repl)
         count = arguments.count
         if count < 0:
             preprocessor.send_error(
@@ -221,7 +240,8 @@ class Cmd_Replace(Command):
         pos = preprocessor.current_position.cmd_begin
         if arguments.text is not None:
             try:
-                return re.sub(pattern, repl, arguments.text, count=count, flags=flags)
+                compiled = get_pattern(kind, name=pattern, flags=flags)
+                return compiled.sub(repl, arguments.text, count=count)
             except re.error as err:
                 preprocessor.send_error(
                     "invalid-argument", "replace regex error: {}".format(err.msg)
@@ -231,8 +251,9 @@ class Cmd_Replace(Command):
         # no text, queue post action
         def fnl_replace(preprocessor: Preprocessor, string: str) -> str:
             try:
+                compiled = get_pattern(kind, name=pattern, flags=flags)
                 return final_action_replace(
-                    preprocessor, string, pattern, repl, flags, count=count
+                    preprocessor, string, compiled, repl, count=count
                 )
             except re.error as err:
                 preprocessor.context.update(pos)
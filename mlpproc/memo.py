@@ -0,0 +1,105 @@
+"""This module implements the memoization of included files
+
+It contains:
+
+- class RenderLog
+    what rendering a file read from the preprocessor's state:
+    the commands and blocks it looked up and the files it included
+
+- class IncludeMemo
+    a bounded cache of rendered files, each with its RenderLog.
+    A rendered file is reused when the commands and files it
+    read are unchanged
+"""
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Dict, Hashable, Optional, Set, Tuple
+
+if TYPE_CHECKING:
+    from .preprocessor import Preprocessor
+
+
+class RenderLog:
+    """Records what a render depends on:
+    - lookups: name -> (command, block) for each name looked up
+    - files: path -> contents of each file included
+    - identities: (device, inode) of each file included
+    - impure: True if the render depends on something else (it printed
+      warnings or used commands with a reads_state attribute, like paste)"""
+
+    __slots__ = ("lookups", "files", "identities", "impure")
+
+    lookups: Dict[str, Tuple[Any, Any]]
+    files: Dict[str, str]
+    identities: Set[Tuple[int, int]]
+    impure: bool
+
+    def __init__(self: "RenderLog") -> None:
+        self.lookups = dict()
+        self.files = dict()
+        self.identities = set()
+        self.impure = False
+
+    def merge(self: "RenderLog", other: "RenderLog") -> None:
+        """adds what other depends on to self (other is a nested render)"""
+        for name, found in other.lookups.items():
+            self.lookups.setdefault(name, found)
+        self.files.update(other.files)
+        self.identities.update(other.identities)
+        self.impure = self.impure or other.impure
+
+    def is_valid(self: "RenderLog", preprocessor: "Preprocessor") -> bool:
+        """returns True if the commands, blocks and files looked up
+        are unchanged in preprocessor"""
+        commands = preprocessor.commands
+        blocks = preprocessor.blocks
+        for name, (command, block) in self.lookups.items():
+            if commands.get(name) is not command or blocks.get(name) is not block:
+                return False
+        file_cache = preprocessor.file_cache
+        if file_cache is None:
+            return not self.files
+        for path, contents in self.files.items():
+            try:
+                current = file_cache.read(path)
+            except OSError:
+                return False
+            if current is not contents and current != contents:
+                return False
+        return True
+
+
+class IncludeMemo:
+    """Rendered files, with their RenderLog, keyed by whatever else their
+    render depends on (contents, tokens, include path...).
+    At most max_entries are kept, least recently used ones are evicted first."""
+
+    max_entries: int
+    hits: int
+    misses: int
+    _entries: "OrderedDict[Hashable, Tuple[RenderLog, str]]"
+
+    def __init__(self: "IncludeMemo", max_entries: int = 256) -> None:
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(
+        self: "IncludeMemo", key: Hashable, preprocessor: "Preprocessor"
+    ) -> Optional[Tuple[RenderLog, str]]:
+        """returns the (log, rendered text) stored with key
+        if its log is still valid, None otherwise"""
+        entry = self._entries.get(key)
+        if entry is None or not entry[0].is_valid(preprocessor):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self: "IncludeMemo", key: Hashable, log: RenderLog, text: str) -> None:
+        """stores the rendered text and its log"""
+        self._entries[key] = (log, text)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
@@ -0,0 +1,168 @@
+"""
+This module contains the regular expressions used by the preprocessor
+namely:
+- the REGEX_* constants (also available from defs)
+- enum PatternKind, the patterns built at runtime from tokens or names
+- class PatternRegistry, a bounded LRU cache of compiled patterns
+- function get_pattern, to access the shared registry
+"""
+import enum
+import re
+from collections import OrderedDict
+from typing import NamedTuple, Pattern, Tuple
+
+REGEX_IDENTIFIER: str = "[_a-zA-Z][_a-zA-Z0-9]*"
+REGEX_IDENTIFIER_WRAPPED: str = "(^|(?<=([^_a-zA-Z0-9]))){}((?=([^_a-zA-Z0-9]))|$)"
+REGEX_IDENTIFIER_END: str = "$|[^_a-zA-Z0-9]"
+REGEX_IDENTIFIER_BEGIN: str = "^|[^_a-zA-Z]"
+REGEX_STRING: str = '""|".*?[^\\\\]"'
+REGEX_INTEGER: str = r"-?\ *[0-9]+(?:[_0-9]*[0-9])?"
+
+
+@enum.unique
+class PatternKind(enum.Enum):
+    """The different patterns built at runtime"""
+
+    IDENTIFIER = enum.auto()  # identifier at start of a command
+    STARTBLOCK = enum.auto()  # <token_begin> name
+    ENDBLOCK = enum.auto()  # <token_begin> <token_endblock>name <token_end>
+    IF = enum.auto()  # if after a <token_begin>
+    ELIF = enum.auto()  # elif after a <token_begin>
+    ELSE = enum.auto()  # else <token_end> after a <token_begin>
+    ENDIF = enum.auto()  # <token_endblock>if <token_end> after a <token_begin>
+    FOR = enum.auto()  # ident in
+    FOR_RANGE = enum.auto()  # range(start, stop, step)
+    WHOLE_WORD = enum.auto()  # name, not part of a larger word
+    MACRO_ARG = enum.auto()  # placeholder of macro argument number name
+    MACRO_SLOT = enum.auto()  # placeholder of any macro argument, captures its number
+    REGEX = enum.auto()  # name is the regex
+    INCLUDE = enum.auto()  # <token_begin> include args <token_end>, args without tokens
+
+
+PatternKey = Tuple[PatternKind, str, str, str, str, int]
+
+
+def build_regex(
+    kind: PatternKind, token_begin: str, token_end: str, token_endblock: str, name: str
+) -> str:
+    """returns the source of the regex of the given kind"""
+    if kind == PatternKind.IDENTIFIER:
+        return r"\s*({})({}.*$)".format(REGEX_IDENTIFIER, REGEX_IDENTIFIER_END)
+    if kind == PatternKind.STARTBLOCK:
+        return r"{}\s*{}(?:{}|{})".format(
+            re.escape(token_begin), name, re.escape(token_end), REGEX_IDENTIFIER_END
+        )
+    if kind == PatternKind.ENDBLOCK:
+        return r"{}\s*{}{}\s*{}".format(
+            re.escape(token_begin),
+            re.escape(token_endblock),
+            name,
+            re.escape(token_end),
+        )
+    if kind == PatternKind.IF:
+        return r"\s*if(?:{}|{})".format(re.escape(token_end), REGEX_IDENTIFIER_END)
+    if kind == PatternKind.ELIF:
+        return r"\s*(elif)(?:{}|{})".format(re.escape(token_end), REGEX_IDENTIFIER_END)
+    if kind == PatternKind.ELSE:
+        return r"\s*else\s*{}".format(re.escape(token_end))
+    if kind == PatternKind.ENDIF:
+        return r"\s*{}if\s*{}".format(re.escape(token_endblock), re.escape(token_end))
+    if kind == PatternKind.FOR:
+        return r"^\s*({})\s+in\s+".format(REGEX_IDENTIFIER)
+    if kind == PatternKind.FOR_RANGE:
+        return r"range\((?:\s*({nb})\s*,)?\s*({nb})\s*(?:,\s*({nb})\s*)?\)".format(
+            nb=REGEX_INTEGER
+        )
+    if kind == PatternKind.WHOLE_WORD:
+        return REGEX_IDENTIFIER_WRAPPED.format(re.escape(name))
+    if kind == PatternKind.INCLUDE:
+        return r"{}\s*include\s((?:(?!{}).)*?){}".format(
+            re.escape(token_begin), re.escape(token_begin), re.escape(token_end)
+        )
+    if kind == PatternKind.MACRO_ARG:
+        return re.escape("\000(arg {})\000".format(name))
+    if kind == PatternKind.MACRO_SLOT:
+        return re.escape("\000(arg ") + r"(\d+)" + re.escape(")\000")
+    return name
+
+
+class PatternCacheInfo(NamedTuple):
+    """Statistics of a PatternRegistry"""
+
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+
+class PatternRegistry:
+    """A bounded LRU cache of compiled regular expressions, keyed by
+    (kind, token_begin, token_end, token_endblock, name, flags).
+
+    The stdlib re cache is small and shared by every regex in the program,
+    documents using many commands and blocks easily thrash it."""
+
+    maxsize: int
+    hits: int
+    misses: int
+    _patterns: "OrderedDict[PatternKey, Pattern[str]]"
+
+    def __init__(self: "PatternRegistry", maxsize: int = 512) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._patterns = OrderedDict()
+
+    def __len__(self: "PatternRegistry") -> int:
+        return len(self._patterns)
+
+    def get(
+        self: "PatternRegistry",
+        kind: PatternKind,
+        token_begin: str = "",
+        token_end: str = "",
+        token_endblock: str = "",
+        name: str = "",
+        flags: int = 0,
+    ) -> Pattern[str]:
+        """returns the compiled pattern of the given kind,
+        compiling it if it isn't in cache.
+        Raises re.error if the pattern is invalid (only for PatternKind.REGEX)"""
+        key = (kind, token_begin, token_end, token_endblock, name, flags)
+        pattern = self._patterns.get(key)
+        if pattern is not None:
+            self.hits += 1
+            self._patterns.move_to_end(key)
+            return pattern
+        self.misses += 1
+        source = build_regex(kind, token_begin, token_end, token_endblock, name)
+        pattern = re.compile(source, flags)
+        self._patterns[key] = pattern
+        if len(self._patterns) > self.maxsize:
+            self._patterns.popitem(last=False)
+        return pattern
+
+    def cache_info(self: "PatternRegistry") -> PatternCacheInfo:
+        """returns hit, miss, max size and current size"""
+        return PatternCacheInfo(self.hits, self.misses, self.maxsize, len(self))
+
+    def clear(self: "PatternRegistry") -> None:
+        """empties the cache and resets statistics"""
+        self._patterns.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+patterns = PatternRegistry()
+
+
+def get_pattern(
+    kind: PatternKind,
+    token_begin: str = "",
+    token_end: str = "",
+    token_endblock: str = "",
+    name: str = "",
+    flags: int = 0,
+) -> Pattern[str]:
+    """returns a compiled pattern from the shared registry"""
+    return patterns.get(kind, token_begin, token_end, token_endblock, name, flags)
@@ -2,14 +2,27 @@
 Definitions of the actual Preprocessor class
 """
 import re
-from sys import stderr
-from typing import Any, Callable, Dict, List, Tuple
+import sys
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Pattern,
+    Tuple,
+    TypeVar,
+    Union,
+)
+from uuid import uuid4
 
+from .buffer import TextBuffer, TextOrBuffer
+from .cache import DiskCache
 from .context import ContextStack, FileDescriptor
 from .defs import (
     PREPROCESSOR_NAME,
     PREPROCESSOR_VERSION,
-    REGEX_IDENTIFIER_END,
     Position,
     TokenMatch,
     get_identifier_name,
@@ -17,14 +30,24 @@ from .defs import (
     trim,
 )
 from .errors import ErrorMode, PreprocessorError, PreprocessorWarning, WarningMode
+from .files import FileCache, file_identity
 from .labels import LabelStack
+from .memo import IncludeMemo, RenderLog
+from .patterns import PatternKind, get_pattern
+from .template import ParsedText, Template
+from .tokens import BlockIndex, Token, TokenList, find_tokens
 
 
 class Command:
     """A generic command: a function that takes the preprocessor
     object as well a the string of arguments and generates an output string"""
 
+    __slots__ = ()
+
     doc: str
+    # True if the output depends on state other than the arguments and
+    # the commands used, includes using it are never memoized
+    reads_state: bool = False
 
     def __call__(self, preproc: "Preprocessor", args: str) -> str:
         raise ValueError("Overwrite __call__ in subclasses")
@@ -36,12 +59,25 @@ class Block:
     and generates an output string"""
 
     doc: str
+    # see Command.reads_state
+    reads_state: bool = False
 
     def __call__(self, preproc: "Preprocessor", args: str, content: str) -> str:
         raise ValueError("Overwrite __call__ in subclasses")
 
 
-TokenList = List[Tuple[int, int, TokenMatch]]
+FunctionType = TypeVar("FunctionType", bound=Callable[..., Any])
+
+
+def edits_buffer(action: FunctionType) -> FunctionType:
+    """Decorator marking final actions that can edit a TextBuffer.
+    These actions must accept either a str or a TextBuffer as text argument.
+    When run on the whole document, they receive the document's TextBuffer and
+    should edit it in place (with Preprocessor.replace_string), sparing a copy
+    of the document. Other final actions receive and return a str.
+    Callable objects can set a class attribute edits_buffer = True instead."""
+    setattr(action, "edits_buffer", True)
+    return action
 
 
 class Preprocessor:
@@ -69,6 +105,30 @@ class Preprocessor:
     | AS_ERROR -> passes to self.send_error()
       - use_color: bool (default False)
           if True, uses ansi color when priting errors
+      - disk_cache: Optional[DiskCache] (default None)
+          if set, render() loads and saves the tokens and block positions
+          of the document and included files in this cache
+      - include_once: bool (default False)
+          if True, include skips files that were already included
+      - file_cache: Optional[FileCache] (default a new FileCache)
+          include reads files and searches the include path through this cache
+          (or directly if None). It can be shared by several preprocessors
+      - include_memo: Optional[IncludeMemo] (default None)
+          if set, include reuses the rendered text of files whose render didn't
+          change the preprocessor's state, when they are included again
+          with the same commands (ignored if file_cache is None).
+          Only enable it if all commands and blocks that change commands, blocks
+          or command_vars call state_changed(), and those whose output depends
+          on anything else set reads_state
+      - defer_verbatim: bool (default False)
+          if True, verbatim includes placed directly in the document are
+          replaced by markers, see defer_file. They are only read if a final
+          action needs to inspect the text, process() returns the markers otherwise.
+          Files written with write_spliced are copied byte for byte, without
+          decoding or line ending translation
+      - prefetch_includes: bool (default False)
+          if True, files included with a literal path are read on a thread pool
+          (see FileCache.prefetch) as soon as the file including them is loaded
     """
 
     # constants
@@ -81,6 +141,10 @@ class Preprocessor:
     safe_calls: bool = True
     use_color: bool = False
     string_delimiters: str = "\"'"
+    disk_cache: Optional[DiskCache] = None
+    include_once: bool = False
+    defer_verbatim: bool = False
+    prefetch_includes: bool = False
 
     # warning and error modes
     error_mode: ErrorMode = ErrorMode.RAISE
@@ -89,6 +153,11 @@ class Preprocessor:
 
     # private attributes
     _recursion_depth: int
+    _template: Optional[Template]
+    _render_logs: List[RenderLog]
+    _nested_command: bool
+    _deferred_prefix: str
+    _deferred_pattern: Pattern[str]
 
     # commands and blocks
     commands: Dict[str, Command] = dict()
@@ -101,6 +170,13 @@ class Preprocessor:
     context: ContextStack
     current_position: Position
     include_path: List[str]
+    file_cache: Optional[FileCache]
+    include_memo: Optional[IncludeMemo]
+    deferred_files: List[str]
+    dependencies: List[str]
+    absent_dependencies: List[str]
+    volatile: bool
+    generation: int
 
     def __init__(self) -> None:
         self.commands = Preprocessor.commands.copy()
@@ -111,7 +187,21 @@ class Preprocessor:
         self.context = ContextStack()
         self.labels = LabelStack()
         self._recursion_depth = 0
+        self._template = None
         self.include_path = list()
+        self.file_cache = FileCache()
+        self.include_memo = None
+        self._render_logs = list()
+        self._nested_command = False
+        self.deferred_files = list()
+        self._deferred_prefix = "\0mlpp-file-{}:".format(uuid4().hex)
+        self._deferred_pattern = re.compile(
+            re.escape(self._deferred_prefix) + "(\\d+)\0"
+        )
+        self.dependencies = list()
+        self.absent_dependencies = list()
+        self.volatile = False
+        self.generation = 0
         self.silent_warnings = Preprocessor.silent_warnings.copy()
 
     def send_error(self: "Preprocessor", name: str, error_msg: str) -> None:
@@ -126,10 +216,10 @@ class Preprocessor:
         """
         error = PreprocessorError(name, error_msg, self.context)
         if self.error_mode == ErrorMode.PRINT_AND_EXIT:
-            print(error.pretty_message(self.use_color), file=stderr)
+            print(error.pretty_message(self.use_color), file=sys.stderr)
             exit(self.exit_code)
         if self.error_mode == ErrorMode.PRINT_AND_RAISE:
-            print(error.pretty_message(self.use_color), file=stderr)
+            print(error.pretty_message(self.use_color), file=sys.stderr)
         raise error
 
     def send_warning(self: "Preprocessor", name: str, warning_msg: str) -> None:
@@ -146,6 +236,8 @@ class Preprocessor:
           | RAISE -> raise python warning
           | AS_ERROR -> passes to self.send_error()
         """
+        if self._render_logs:
+            self._render_logs[-1].impure = True
         if name in self.silent_warnings:
             return
         warning = PreprocessorWarning(name, warning_msg, self.context)
@@ -153,7 +245,7 @@ class Preprocessor:
             self.warning_mode == WarningMode.PRINT
             or self.warning_mode == WarningMode.PRINT_AND_RAISE
         ):
-            print(warning.pretty_message(self.use_color), file=stderr)
+            print(warning.pretty_message(self.use_color), file=sys.stderr)
         if (
             self.warning_mode == WarningMode.RAISE
             or self.warning_mode == WarningMode.PRINT_AND_RAISE
@@ -162,6 +254,22 @@ class Preprocessor:
         if self.warning_mode == WarningMode.AS_ERROR:
             self.send_error("from-warning-" + name, warning_msg)
 
+    def lookup(
+        self: "Preprocessor", ident: str
+    ) -> Tuple[Optional[Command], Optional[Block]]:
+        """returns the (command, block) named ident, None if undefined.
+        The lookup is recorded for the memoization of includes"""
+        command = self.commands.get(ident)
+        block = self.blocks.get(ident)
+        if self._render_logs:
+            log = self._render_logs[-1]
+            log.lookups.setdefault(ident, (command, block))
+            if getattr(command, "reads_state", False) or getattr(
+                block, "reads_state", False
+            ):
+                log.impure = True
+        return command, block
+
     def split_args(self: "Preprocessor", args: str) -> List[str]:
         """Splits args along space like on the command line
         preserves strings
@@ -205,37 +313,48 @@ class Preprocessor:
             arg_list.append(args[last_blank:ii].replace("\\ ", " "))
         return arg_list
 
-    def _find_tokens(self: "Preprocessor", string: str) -> TokenList:
-        """Find all tokens (begin/end) in string
+    def _find_tokens(
+        self: "Preprocessor", string: str, start: int = 0, end: Optional[int] = None
+    ) -> List[Token]:
+        """Find all tokens (begin/end) in string[start:end]
         Inputs:
                 string: str - the string to search for tokens
+                start, end: int - optional bounds of the search
         Returns:
-                tokens: List[int, TokenMatch] - list of (position, OPEN/CLOSE)
-                        sorted by position (CLOSE comes first if equal)
+                tokens: List[int, int, TokenMatch] - list of (start, end, OPEN/CLOSE)
+                        sorted by position (OPEN comes first if equal)
+                        positions are relative to string
         """
-        open_tokens = re.finditer(re.escape(self.token_begin), string, self.re_flags)
-        close_tokens = re.finditer(re.escape(self.token_end), string, self.re_flags)
-        tokens = [(x.start(), x.end(), TokenMatch.OPEN) for x in open_tokens]
-        tokens += [(x.start(), x.end(), TokenMatch.CLOSE) for x in close_tokens]
-        # sort in order of appearance - if two tokens appear at same place
-        # sort CLOSE first
-        tokens.sort(key=lambda x: x[0] + 0.5 * int(x[2]))
-        return tokens
+        return find_tokens(string, self.token_begin, self.token_end, start, end)
+
+    def _parsed_text(self: "Preprocessor", string: str) -> ParsedText:
+        """returns the tokens of string (and a dict to store its block indexes)
+        reuses those of the template being rendered if any"""
+        if self._template is not None:
+            return self._template.parsed_text(string, self.token_begin, self.token_end)
+        return ParsedText(self._find_tokens(string))
 
     @staticmethod
-    def _find_matching_pair(tokens: TokenList) -> int:
-        """find the first innermost OPEN CLOSE pair in tokens
+    def _find_matching_pair(
+        tokens: Union[TokenList, List[Token]], start: int = 0
+    ) -> int:
+        """find the first innermost OPEN CLOSE pair in tokens[start:]
                   Inputs:
-                    tokens - list of tuples containing 4 elements
-                                  tokens[i][3] should be a boolean indicating
-                                  OPEN with True and CLOSE with False
+                    tokens - list of tokens (start, end, OPEN/CLOSE)
                                   Assumed to be at least 2 elements long
+                    start - index to start searching from
                   Returns:
-        the first index i such that tokens[i][3] == True and tokens[i+1][3] == False
+        the first index i >= start such that tokens[i][2] == OPEN and tokens[i+1][2] == CLOSE
         -1 if no such index exists
-        """
+
+        The parse loop resumes the search from the OPEN token that precedes the
+        last pair it replaced. Every token before it is an unmatched OPEN (the
+        stack of pending tokens), so it can't be part of an earlier pair and the
+        search costs linear time over a whole parse."""
         len_tokens = len(tokens)
-        token_index = 0
+        token_index = start
+        if token_index + 1 >= len_tokens:
+            return -1
         while (
             tokens[token_index][2] != TokenMatch.OPEN
             or tokens[token_index + 1][2] != TokenMatch.CLOSE
@@ -245,6 +364,31 @@ class Preprocessor:
                 return -1
         return token_index
 
+    def _block_index(self: "Preprocessor", block_name: str, string: str) -> BlockIndex:
+        """Indexes the startblock and endblock tokens of block_name in string
+        Inputs:
+                block_name: str - the name of the block.
+                        it is used to determine the endblock and startblock tokens
+                string: str - the string being parsed
+        Returns:
+                a BlockIndex, used to find matching endblocks"""
+        endblock_regex = get_pattern(
+            PatternKind.ENDBLOCK,
+            self.token_begin,
+            self.token_end,
+            self.token_endblock,
+            block_name,
+            self.re_flags,
+        )
+        startblock_regex = get_pattern(
+            PatternKind.STARTBLOCK,
+            self.token_begin,
+            self.token_end,
+            name=block_name,
+            flags=self.re_flags,
+        )
+        return BlockIndex(string, self.token_begin, startblock_regex, endblock_regex)
+
     def _find_matching_endblock(
         self: "Preprocessor", block_name: str, string: str
     ) -> Tuple[int, int]:
@@ -258,81 +402,55 @@ class Preprocessor:
         Returns:
                 tuple(endblock_start_pos: int, endblock_end_pos: int)
                 (-1,-1) if no such endblock exists"""
-        endblock_regex = r"{}\s*{}{}\s*{}".format(
-            re.escape(self.token_begin),
-            re.escape(self.token_endblock),
-            block_name,
-            re.escape(self.token_end),
-        )
-        startblock_regex = r"{}\s*{}(?:{}|{})".format(
-            re.escape(self.token_begin),
-            block_name,
-            re.escape(self.token_end),
-            REGEX_IDENTIFIER_END,
-        )
-        pos = 0
-        open_block = 0
-        match_begin = re.search(startblock_regex, string, self.re_flags)
-        match_end = re.search(endblock_regex, string, self.re_flags)
-        while True:
-            if match_end is None:
-                return -1, -1
-            if match_begin is None:
-                open_block -= 1
-                if open_block == -1:
-                    return pos + match_end.start(), pos + match_end.end()
-                pos += match_end.end()
-            else:
-                if match_begin.start() < match_end.start():
-                    open_block += 1
-                    pos += match_begin.end()
-                else:
-                    open_block -= 1
-                    if open_block == -1:
-                        return pos + match_end.start(), pos + match_end.end()
-                    pos += match_end.end()
-            match_begin = re.search(startblock_regex, string[pos:], self.re_flags)
-            match_end = re.search(endblock_regex, string[pos:], self.re_flags)
+        return self._block_index(block_name, string).find_endblock(0, len(string))
 
     def replace_string(
         self: "Preprocessor",
         start: int,
         end: int,
-        string: str,
+        string: TextOrBuffer,
         replacement: str,
-        tokens: List[Tuple[int, int, Any]],
+        tokens: Union[TokenList, List[Tuple[int, int, Any]]],
         pop_labels: bool = False,
-    ) -> str:
+    ) -> TextOrBuffer:
         """replaces string[start:end] with replacement
         also add offset to token requiring them
         Inputs:
                 start, end - indexes of the string to replace (relative to start of string)
-                string - the string in which to replace
+                string - the string or TextBuffer in which to replace
                 replacement - the replacement string to place between start and end
-                tokens - list of tokens to add dilation
+                tokens - TokenList or list of tokens to add dilation
         Returns:
                 str = string[:start] + replacement + string[end:]
+                if string is a TextBuffer, it is edited in place and returned
         Effect:
                 removes all tokens occuring between start and end from tokens
                 corrects start and end of further tokens by the length change
         """
-        test_range = range(start, end)
-        i = 0
         dilat = len(replacement) - (end - start)
-        while i < len(tokens):
-            if tokens[i][0] in test_range or tokens[i][1] in test_range:
-                del tokens[i]
-            else:
-                if tokens[i][0] >= end:
-                    tokens[i] = (tokens[i][0] + dilat, tokens[i][1] + dilat) + tokens[
-                        i
-                    ][2:]
-                i += 1
+        if isinstance(tokens, TokenList):
+            tokens.replace(start, end, dilat)
+        else:
+            test_range = range(start, end)
+            i = 0
+            while i < len(tokens):
+                if tokens[i][0] in test_range or tokens[i][1] in test_range:
+                    del tokens[i]
+                else:
+                    if tokens[i][0] >= end:
+                        tokens[i] = (
+                            tokens[i][0] + dilat,
+                            tokens[i][1] + dilat,
+                        ) + tokens[i][2:]
+                    i += 1
         self.context.add_dilatation(start + self.current_position.offset, dilat)
         self.labels.dilate_level(self._recursion_depth, end, dilat)
         # only remove level if it wasn't explicitly removed
         if pop_labels and self.labels.height > self._recursion_depth + 1:
             self.labels.pop_level(start)
+        if isinstance(string, TextBuffer):
+            string.replace(start, end, replacement)
+            return string
         return string[:start] + replacement + string[end:]
 
     def safe_call(
@@ -361,7 +479,9 @@ class Preprocessor:
             return string
         return function(*args, **kwargs)
 
-    def token_error(self: "Preprocessor", tokens: TokenList) -> None:
+    def token_error(
+        self: "Preprocessor", tokens: Union[TokenList, List[Token]]
+    ) -> None:
         """Raises an error for unmatched token on the first token in list"""
         self.current_position.relative_begin = tokens[0][0]
         self.context.update(self.current_position.begin)
@@ -392,6 +512,11 @@ class Preprocessor:
                   (for error display)
         Returns:
                 the resulting string"""
+        return str(self.parse_buffer(TextBuffer(string)))
+
+    def parse_buffer(self: "Preprocessor", buffer: TextBuffer) -> TextBuffer:
+        """same as parse, but edits a TextBuffer in place and returns it.
+        This avoids copying the whole text for every command expanded."""
         # Recursion check
         self._recursion_depth += 1
         if self._recursion_depth == self.max_recursion_depth:
@@ -402,21 +527,29 @@ class Preprocessor:
         # context init
         self.current_position.offset = self.context.top.position
 
-        tokens: TokenList = self._find_tokens(string)
+        source = str(buffer)
+        parsed = self._parsed_text(source)
+        tokens = TokenList(parsed.tokens)
+        # index from which to search the next pair
+        cursor = 0
+        # endblock indexes, built on source when a block is first met
+        block_indexes = parsed.block_indexes
 
         while len(tokens) > 1:  # needs two tokens to make a pair
             # find innermost (nested pair)
             if tokens[0][2] == TokenMatch.CLOSE:
                 self.token_error(tokens)
-            token_index = self._find_matching_pair(tokens)
+            token_index = self._find_matching_pair(tokens, cursor)
             if token_index == -1:
                 self.token_error(tokens)
+            # earlier tokens are unmatched OPEN tokens of enclosing commands
+            self._nested_command = token_index > 0
 
             self.current_position.relative_begin = tokens[token_index][0]
             self.current_position.relative_cmd_begin = tokens[token_index][1]
             self.current_position.relative_cmd_end = tokens[token_index + 1][0]
             self.current_position.relative_end = tokens[token_index + 1][1]
-            substring = string[
+            substring = buffer[
                 self.current_position.relative_cmd_begin : self.current_position.relative_cmd_end
             ]
             ident, arg_string, i = get_identifier_name(substring)
@@ -425,16 +558,19 @@ class Preprocessor:
             self.context.update(self.current_position.begin)
             new_str = ""
             position = self.current_position.copy()
-            if ident in self.commands:
+            command, block = self.lookup(ident)
+            if command is not None:
                 self.context.update(
                     self.current_position.cmd_begin, "in command {}".format(ident)
                 )
-                command = self.commands[ident]
                 new_str = self.safe_call(command, self, arg_string)
                 self.context.pop()
-            elif ident in self.blocks:
-                endblock_b, endblock_e = self._find_matching_endblock(
-                    ident, string[self.current_position.relative_end :]
+            elif block is not None:
+                key = (ident, self.token_begin, self.token_endblock, self.token_end)
+                if key not in block_indexes:
+                    block_indexes[key] = self._block_index(ident, source)
+                endblock_b, endblock_e = block_indexes[key].find_endblock(
+                    self.current_position.relative_end, len(buffer)
                 )
                 if endblock_b == -1:
                     self.send_error(
@@ -449,9 +585,8 @@ class Preprocessor:
                 )
                 left = self.current_position.relative_end
                 right = self.current_position.relative_endblock_begin
-                block_content = string[left:right]
+                block_content = buffer[left:right]
                 end_pos = self.current_position.relative_endblock_end
-                block = self.blocks[ident]
 
                 self.context.update(
                     self.current_position.cmd_begin, "in block {}".format(ident)
@@ -477,33 +612,54 @@ class Preprocessor:
                             " unchanged in output."
                         ).format(ident),
                     )
-                new_str = string[
+                new_str = buffer[
                     self.current_position.relative_begin : self.current_position.relative_end
                 ]
             self.current_position = position
             self.context.pop()
-            string = self.replace_string(
+            self.replace_string(
                 self.current_position.relative_begin,
                 end_pos,
-                string,
+                buffer,
                 new_str,
                 tokens,
                 True,
             )
+            # tokens before the replaced ones are unmatched OPEN tokens,
+            # the last of them may pair with the next CLOSE token
+            cursor = max(tokens.bisect(self.current_position.relative_begin) - 1, 0)
         # end while
         if len(tokens) == 1:
             self.token_error(tokens)
         self._recursion_depth -= 1
-        return string
+        return buffer
 
-    def run_final_actions(self: "Preprocessor", string: str) -> str:
-        """Runs all final actions"""
+    def run_final_actions(self: "Preprocessor", string: TextOrBuffer) -> TextOrBuffer:
+        """Runs all final actions
+        When given a TextBuffer, it is edited in place by actions marked
+        with edits_buffer, and only converted to str for the others.
+        Deferred files are materialized before the first action
+        that doesn't set inspects_text to False"""
+        if isinstance(string, TextBuffer):
+            buffer = string
+        else:
+            buffer = TextBuffer(string)
         self.context.update(self.current_position.from_relative(0), "in final actions")
+        materialized = not self.deferred_files
         for action in self.final_actions:
+            if not materialized and getattr(action, "inspects_text", True):
+                self.materialize(buffer)
+                materialized = True
             # run actions
-            string = self.safe_call(action, self, string)
+            if getattr(action, "edits_buffer", False):
+                self.safe_call(action, self, buffer)
+            else:
+                text = self.safe_call(action, self, str(buffer))
+                buffer.replace(0, len(buffer), text)
         self.context.pop()
-        return string
+        if isinstance(string, TextBuffer):
+            return buffer
+        return str(buffer)
 
     def process(self: "Preprocessor", string: str, filename: str) -> str:
         """parses the string and returns the result
@@ -511,14 +667,286 @@ class Preprocessor:
         - string: str -> the string to process
         - filename: str -> the name of the file (used for error display)
         Returns the processed string"""
-        self.context.new(FileDescriptor(filename, string), 0)
+        return self._process(FileDescriptor(filename, string))
+
+    def _new_document(self: "Preprocessor", filename: str) -> None:
+        """called before processing a document: no file has been included yet,
+        the include stack only contains the document, so including it is a cycle"""
+        try:
+            identity: Optional[Tuple[int, int]] = file_identity(filename)
+        except OSError:
+            identity = None  # not a file (stdin, string...)
+        self.command_vars["include_once"] = set()
+        self.command_vars["include_stack"] = [(identity, filename)]
+
+    def _process(self: "Preprocessor", file: FileDescriptor) -> str:
+        """processes file.contents, see process"""
+        self._new_document(file.filename)
+        self.deferred_files = list()
+        self.load_file(file.contents)
+        self.context.new(file, 0)
         self.labels.new_level()
-        string = self.parse(string)
+        buffer = self.parse_buffer(TextBuffer(file.contents))
         self.labels.pop_level(0)
-        string = self.run_final_actions(string)
+        self.run_final_actions(buffer)
         self.context.pop()
+        return str(buffer)
+
+    def _stream_split(self: "Preprocessor", string: str) -> int:
+        """returns a position p such that string[:p] only contains text and
+        complete top-level commands and blocks, i.e. such that string[:p]
+        parses the same whatever text follows it"""
+        tokens = self._find_tokens(string)
+        block_indexes: Dict[str, BlockIndex] = dict()
+        split = 0
+        depth = 0
+        open_begin = 0
+        i = 0
+        while i < len(tokens):
+            begin, end, token = tokens[i]
+            i += 1
+            if token == TokenMatch.OPEN:
+                if depth == 0:
+                    open_begin = begin
+                depth += 1
+                continue
+            if depth == 0:
+                # unmatched close token, parse_buffer reports it
+                split = end
+                continue
+            depth -= 1
+            if depth != 0:
+                continue
+            split = end
+            ident = get_identifier_name(
+                string[open_begin + len(self.token_begin) : begin]
+            )[0]
+            if ident in self.blocks:
+                if ident not in block_indexes:
+                    block_indexes[ident] = self._block_index(ident, string)
+                endblock_end = block_indexes[ident].find_endblock(end, len(string))[1]
+                if endblock_end == -1:
+                    return open_begin
+                split = end + endblock_end
+                while i < len(tokens) and tokens[i][0] < split:
+                    i += 1
+        if depth != 0:
+            return open_begin
+        # keep what could be the start of a token
+        token_length = max(len(self.token_begin), len(self.token_end))
+        return max(split, len(string) - token_length + 1)
+
+    def process_stream(
+        self: "Preprocessor",
+        reader: IO[str],
+        writer: IO[str],
+        filename: str,
+        chunk_size: int = 1 << 16,
+    ) -> None:
+        """processes the text read from reader and writes the result to writer.
+        Inputs:
+        - reader: IO[str] -> a text stream with a read(size) method
+        - writer: IO[str] -> a text stream with a write(str) method
+        - filename: str -> the name of the file (used for error display)
+        - chunk_size: int -> minimum number of characters read at once
+
+        Unlike process, the whole input is not loaded at once: it is split
+        after complete top-level commands and blocks, and each part is parsed
+        when read. The output is written as soon as no label, pending atlabel
+        block, or queued final action can still modify it. So memory use
+        stays proportional to the largest top-level block (and to the text
+        held back by labels or final actions).
+
+        The output is the same as process(reader.read(), filename) except that
+        final actions and atlabel blocks don't affect text already written,
+        i.e. text before the first label or the first final action queued.
+        Final actions present when the stream starts are run on each
+        written part."""
+        baseline_actions = self.final_actions.copy()
+        held = TextBuffer()
+        self._new_document(filename)
+        self.context.new(FileDescriptor(filename, ""), 0)
+        self.labels.new_level()
+        pending = ""
+        line_offset = 0
+        char_offset = 0
+        read_size = chunk_size
+        eof = False
+        while not eof:
+            chunk = reader.read(read_size)
+            eof = chunk == ""
+            pending += chunk
+            split = len(pending) if eof else self._stream_split(pending)
+            if split <= 0:
+                # read more at once when a construct spans many chunks
+                read_size = max(chunk_size, len(pending))
+                continue
+            read_size = chunk_size
+            segment = pending[:split]
+            pending = pending[split:]
+            file = FileDescriptor(filename, segment, line_offset, char_offset)
+            last_break = segment.rfind("\n")
+            if last_break == -1:
+                char_offset += len(segment)
+            else:
+                line_offset += segment.count("\n")
+                char_offset = len(segment) - last_break
+            self.context.new(file, 0)
+            self.labels.new_level()
+            output = self.parse_buffer(TextBuffer(segment))
+            self.labels.pop_level(len(held))
+            self.context.pop()
+            held.replace(len(held), len(held), str(output))
+            if (
+                self.final_actions == baseline_actions
+                and not self.labels.top_level
+                and not self.command_vars.get("atlabel")
+            ):
+                writer.write(str(self.run_final_actions(held)))
+                held = TextBuffer()
+        writer.write(str(self.run_final_actions(held)))
+        self.labels.forget_level()
+        self.context.pop()
+
+    def compile(self: "Preprocessor", string: str, filename: str) -> Template:
+        """compiles string into a template, that can be rendered
+        any number of times with self.render.
+        Inputs:
+        - string: str -> the string to process
+        - filename: str -> the name of the file (used for error display)
+        Returns a Template. The string is tokenized with the current tokens"""
+        template = Template(string, filename)
+        if self.disk_cache is not None:
+            template.load_file(
+                string, self.token_begin, self.token_end, self.disk_cache
+            )
+        else:
+            template.parsed_text(string, self.token_begin, self.token_end)
+        return template
+
+    def render(self: "Preprocessor", template: Template) -> str:
+        """renders a compiled template, same as
+        self.process(template.source, template.filename)
+        but reuses the tokens and block positions found in previous renders
+        (including those of the contents of blocks).
+        Returns the processed string"""
+        previous = self._template
+        self._template = template
+        try:
+            result = self._process(template.file)
+            if self.disk_cache is not None:
+                template.save_files(self.disk_cache)
+            return result
+        finally:
+            self._template = previous
+
+    def load_file(self: "Preprocessor", string: str) -> None:
+        """called with the contents of a file before parsing them.
+        When rendering a template with a disk_cache, gets the tokens and
+        block positions of string from the cache (they are saved
+        back at the end of the render).
+        With prefetch_includes, starts reading the files it includes."""
+        if self._template is not None and self.disk_cache is not None:
+            self._template.load_file(
+                string, self.token_begin, self.token_end, self.disk_cache
+            )
+        if self.prefetch_includes and self.file_cache is not None:
+            self.file_cache.prefetch(self.literal_includes(string), self.include_path)
+
+    def literal_includes(self: "Preprocessor", string: str) -> List[str]:
+        """returns the paths of files included in string by include commands
+        with literal arguments (no strings, escapes or nested commands).
+        This is a quick scan, it ignores blocks: some files may not be
+        included when string is parsed, and others may be missing"""
+        pattern = get_pattern(PatternKind.INCLUDE, self.token_begin, self.token_end)
+        names = []
+        for match in pattern.finditer(string):
+            args = match.group(1)
+            if any(char in args for char in self.string_delimiters + "\\"):
+                continue
+            words = args.split()
+            paths = []
+            verbatim = False
+            i = 0
+            while i < len(words):
+                if words[i] in ("-b", "--begin", "-e", "--end"):
+                    i += 1
+                elif words[i] in ("-v", "--verbatim"):
+                    verbatim = True
+                elif words[i] not in ("-o", "--once"):
+                    paths.append(words[i])
+                i += 1
+            # deferred verbatim files aren't read
+            if len(paths) == 1 and not (verbatim and self.defer_verbatim):
+                if not paths[0].startswith("-"):
+                    names.append(paths[0])
+        return names
+
+    def can_defer(self: "Preprocessor") -> bool:
+        """returns True if defer_verbatim is set and the output of the current
+        command is placed as is in the document: the command isn't in a block,
+        an included file or the arguments of another command"""
+        return (
+            self.defer_verbatim
+            and self._recursion_depth == 1
+            and not self._nested_command
+        )
+
+    def defer_file(self: "Preprocessor", path: str) -> str:
+        """returns a marker standing for the contents of the file at path.
+        Markers are replaced by the files' contents by materialize(),
+        split_deferred() locates them to copy the files when writing the output.
+        They are only valid until the next call to process()"""
+        self.deferred_files.append(path)
+        return "{}{}\0".format(self._deferred_prefix, len(self.deferred_files) - 1)
+
+    def split_deferred(self: "Preprocessor", string: str) -> List[str]:
+        """splits string on deferred file markers, returns a list alternating
+        text and paths of the files in between (see mlpproc.files.write_spliced)"""
+        parts = self._deferred_pattern.split(string)
+        for i in range(1, len(parts), 2):
+            parts[i] = self.deferred_files[int(parts[i])]
+        return parts
+
+    def materialize(self: "Preprocessor", string: TextOrBuffer) -> TextOrBuffer:
+        """replaces deferred file markers in string with the files' contents.
+        Labels after the markers are shifted accordingly"""
+        if not self.deferred_files:
+            return string
+        matches = list(self._deferred_pattern.finditer(str(string)))
+        for match in reversed(matches):
+            path = self.deferred_files[int(match.group(1))]
+            try:
+                if self.file_cache is not None:
+                    contents = self.file_cache.read(path)
+                else:
+                    with open(path, "r") as file:
+                        contents = file.read()
+            except OSError:
+                self.send_error("file-error", 'can\'t open file "{}"'.format(path))
+            string = self.replace_string(
+                match.start(), match.end(), string, contents, []
+            )
         return string
 
+    def state_changed(self: "Preprocessor") -> None:
+        """called by commands and blocks that change commands, blocks
+        or command_vars (definitions, clipboards...).
+        Increments generation, includes during which it changes aren't memoized"""
+        self.generation += 1
+
+    def add_dependency(self: "Preprocessor", path: str) -> None:
+        """records that the output depends on the file at path
+        (called by commands that open files, like include)"""
+        if path not in self.dependencies:
+            self.dependencies.append(path)
+
+    def add_absent_dependency(self: "Preprocessor", path: str) -> None:
+        """records that the output would change if a file was created at path
+        (called by include for the paths searched before the file found)"""
+        if path not in self.absent_dependencies:
+            self.absent_dependencies.append(path)
+
     def get_help(self: "Preprocessor", help_msg: str) -> str:
         """used to get and display help on the command line
         help_msg is either:
@@ -539,11 +967,28 @@ class Preprocessor:
                 A list of commands and blocks can be obtained with "--help commands"
 
                 Usage: {name} [--flags] [input_file]
+                       {name} [--flags] --output-dir <dir> input_files...
                     default input_file is stdin
 
                 Options:
                     -o --output <file>   specifies a file to write output to
                                 default is stdout
+                    -O --output-dir <dir> process all input files, writing outputs
+                                to dir (with the same file names)
+                    --files-from <file>  read input files from file (one per line)
+                    -j --jobs <number>   process input files on number processes
+                                (0 for one per CPU, default 1)
+                    --shared-includes    share included files between these processes
+                    --write-if-changed   only write output files whose contents change,
+                                through a temporary file moved in place
+                    --watch              keep running and process inputs again when
+                                they or files they include change
+                    -M                   print a Makefile rule listing the input and the
+                                files it reads (with include...) instead of the output
+                    -MF <file>           also write this rule to file
+                    -MD                  also write this rule to <output_file>.d
+                    -MT <target>         target of the rule (default is the output file)
+                    -MP                  add an empty rule for each dependency
                     -b --begin <string>  change the begin token (default is "{begin}")
                     -e --end <string>    change the end token (default is "{end}")
                     -r --recursion_depth <number> set the max recursion depth (default {rec}).
@@ -551,6 +996,10 @@ class Preprocessor:
                     -d -D --define <name>[=<value>] defines a simple command
                                 with name <name> which prints <value> (nothing if no value)
                                 Can be used multiple times on command line
+                    --define-file <file> defines a command for each name=value line
+                                of file (or each key of a JSON object if it ends with .json).
+                                Values are only parsed if they contain tokens.
+                                Can be used multiple times, -D defines take precedence
                     -i -I --include <path> Adds paths to the INCLUDE_PATH.
                                 default INCLUDE_PATH is [".", dir(input_file), dir(output_file)]
                                 Can be used multiple times on command line
@@ -558,6 +1007,27 @@ class Preprocessor:
                     -w --warnings <hide|error> choose whether to hide warnings
                                 or have them raise an error. default is display.
                     -s --silent <warning_name> silence a specific warning (ex: extra-arguments)
+                    --include-once       include each file at most once
+                    --memoize-includes   render files included several times once
+                                when their render has no side effects
+                    --prefetch           read included files ahead of time,
+                                on several threads
+                    --copy-verbatim      copy files included verbatim directly in the
+                                document to the output file without reading them.
+                                They are copied as is: line endings aren't translated
+                                and the encoding isn't checked
+
+                    --cache-dir <dir>    cache the tokens and block positions of the input
+                                and included files in dir, to reuse them on later runs.
+                                Outputs are also reused while the input, options and
+                                included files are unchanged
+                    --cache-size <MiB>   maximum size of the cache (default 256), least
+                                recently used entries are removed
+                    --cache-check        remove invalid entries from the cache and exit
+                    --cache-clean        empty the cache and exit
+                    --stream             process the input as it is read and write
+                                output as soon as possible. Final actions only
+                                affect the text that follows them
 
                     -v --version         show version and exit
                     -h --help            show this help and exit
@@ -0,0 +1,166 @@
+"""This module implements compiled templates
+
+It contains:
+
+- class ParsedText
+    what the parser computes on a string before expanding commands:
+    its tokens and the block indexes built while expanding them
+
+- class Template
+    a document compiled by Preprocessor.compile, rendered by Preprocessor.render.
+    It keeps the ParsedText of every string parsed while rendering it, so
+    that rendering it again doesn't tokenize or match blocks again.
+    The ParsedText of files can also be saved to and loaded from a DiskCache.
+"""
+import json
+import sys
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+from .cache import DiskCache, hash_key
+from .context import FileDescriptor
+from .defs import TokenMatch
+from .tokens import BlockIndex, Token, find_tokens
+
+# (block name, token_begin, token_endblock, token_end)
+BlockKey = Tuple[str, str, str, str]
+
+
+class ParsedText:
+    """The tokens of a string and the block indexes built on it
+    Neither should be modified once built (block indexes can be added)"""
+
+    __slots__ = ("tokens", "block_indexes")
+
+    tokens: List[Token]
+    block_indexes: Dict[BlockKey, BlockIndex]
+
+    def __init__(self: "ParsedText", tokens: List[Token]) -> None:
+        self.tokens = tokens
+        self.block_indexes = dict()
+
+    def dump(self: "ParsedText") -> bytes:
+        """serializes self: a json header line followed by an array of ints"""
+        ints = array("q")
+        for start, end, token in self.tokens:
+            ints.extend((start, end, int(token)))
+        blocks = []
+        for key, index in self.block_indexes.items():
+            length, positions, ends, matches = index.to_lists()
+            blocks.append(list(key) + [length, len(positions)])
+            ints.extend(positions)
+            ints.extend(ends)
+            ints.extend(matches)
+        header = {
+            "byteorder": sys.byteorder,
+            "tokens": len(self.tokens),
+            "blocks": blocks,
+        }
+        return json.dumps(header).encode() + b"\n" + ints.tobytes()
+
+    @classmethod
+    def load(cls, data: bytes) -> Optional["ParsedText"]:
+        """deserializes data created by dump, returns None if it is invalid"""
+        try:
+            line_end = data.index(b"\n")
+            header = json.loads(data[:line_end])
+            if header["byteorder"] != sys.byteorder:
+                return None
+            ints = array("q")
+            ints.frombytes(data[line_end + 1 :])
+            values = ints.tolist()
+            nb_tokens = header["tokens"]
+            tokens = [
+                (values[i], values[i + 1], TokenMatch(values[i + 2]))
+                for i in range(0, 3 * nb_tokens, 3)
+            ]
+            parsed = cls(tokens)
+            pos = 3 * nb_tokens
+            for name, begin, endblock, end, length, nb_tags in header["blocks"]:
+                parsed.block_indexes[(name, begin, endblock, end)] = (
+                    BlockIndex.from_lists(
+                        length,
+                        values[pos : pos + nb_tags],
+                        values[pos + nb_tags : pos + 2 * nb_tags],
+                        values[pos + 2 * nb_tags : pos + 3 * nb_tags],
+                    )
+                )
+                pos += 3 * nb_tags
+            if pos != len(values):
+                return None
+            return parsed
+        except (ValueError, KeyError, TypeError):
+            return None
+
+
+class Template:
+    """A compiled document, see Preprocessor.compile
+
+    Parsing only depends on the string being parsed and the tokens,
+    so the ParsedText of a string is reused whenever the same string is
+    parsed again with the same tokens. This covers the document itself
+    and the contents of its blocks. Strings that change between renders
+    (like macro expansions) are cached as well, up to max_cached strings."""
+
+    source: str
+    filename: str
+    file: FileDescriptor
+    max_cached: int = 1024
+    _parsed: Dict[Tuple[str, str, str], ParsedText]
+    # files loaded from a DiskCache: cache key and number of block indexes
+    _files: Dict[Tuple[str, str, str], Tuple[str, int]]
+
+    def __init__(self: "Template", source: str, filename: str) -> None:
+        self.source = source
+        self.filename = filename
+        self.file = FileDescriptor(filename, source)
+        self._parsed = dict()
+        self._files = dict()
+
+    def parsed_text(
+        self: "Template", string: str, token_begin: str, token_end: str
+    ) -> ParsedText:
+        """returns the ParsedText of string, computing it if needed"""
+        key = (string, token_begin, token_end)
+        parsed = self._parsed.get(key)
+        if parsed is None:
+            parsed = ParsedText(find_tokens(string, token_begin, token_end))
+            if len(self._parsed) < self.max_cached:
+                self._parsed[key] = parsed
+        return parsed
+
+    def load_file(
+        self: "Template",
+        string: str,
+        token_begin: str,
+        token_end: str,
+        cache: DiskCache,
+    ) -> None:
+        """gets the ParsedText of a file's contents from cache.
+        It is computed if not found, and saved by save_files"""
+        key = (string, token_begin, token_end)
+        if key in self._files:
+            return
+        cache_key = hash_key(string, token_begin, token_end)
+        parsed = self._parsed.get(key)
+        if parsed is None:
+            data = cache.get("parse", cache_key)
+            if data is not None:
+                parsed = ParsedText.load(data)
+            if parsed is None:
+                parsed = ParsedText(find_tokens(string, token_begin, token_end))
+                self._files[key] = (cache_key, -1)
+            else:
+                self._files[key] = (cache_key, len(parsed.block_indexes))
+            self._parsed[key] = parsed
+        else:
+            self._files[key] = (cache_key, -1)
+
+    def save_files(self: "Template", cache: DiskCache) -> None:
+        """saves the ParsedText of files loaded with load_file
+        if they weren't in cache or if blocks were indexed since"""
+        for key, (cache_key, nb_indexes) in self._files.items():
+            parsed = self._parsed[key]
+            if len(parsed.block_indexes) != nb_indexes:
+                cache.put("parse", cache_key, parsed.dump())
+                self._files[key] = (cache_key, len(parsed.block_indexes))
@@ -0,0 +1,270 @@
+"""This module handles token positions in the text being parsed
+
+It contains:
+
+- function find_tokens
+    the tokenizer, finds all begin/end tokens in a single pass
+
+- class TokenList
+    a sorted list of tokens (start, end, value) that keeps positions
+    up to date when the text is edited, without rewriting every token
+
+- class BlockIndex
+    matches every startblock tag of a given block to its endblock tag
+"""
+from bisect import bisect_left
+from typing import Any, Iterable, List, Optional, Pattern, Tuple
+
+from .defs import TokenMatch
+
+Token = Tuple[int, int, TokenMatch]
+
+
+def find_tokens(
+    string: str,
+    token_begin: str,
+    token_end: str,
+    start: int = 0,
+    end: Optional[int] = None,
+) -> List[Token]:
+    """Find all tokens (begin/end) in string[start:end]
+    Inputs:
+            string: str - the string to search for tokens
+            token_begin, token_end: str - the (literal) tokens to find
+            start, end: int - bounds of the search, tokens must fit
+                    between them. Positions are relative to string
+    Returns:
+            tokens: List[int, int, TokenMatch] - list of (start, end, OPEN/CLOSE)
+                    sorted by position (OPEN comes first if equal)
+    Both tokens are searched with str.find simultaneously, merging
+    the two cursors keeps the list sorted without sorting it."""
+    if end is None:
+        end = len(string)
+    find = string.find
+    len_begin = len(token_begin)
+    len_end = len(token_end)
+    # step past each match, like re.finditer, even for empty tokens
+    step_begin = max(len_begin, 1)
+    step_end = max(len_end, 1)
+    tokens: List[Token] = []
+    open_pos = find(token_begin, start, end)
+    close_pos = find(token_end, start, end)
+    while close_pos != -1:
+        while open_pos != -1 and open_pos <= close_pos:
+            tokens.append((open_pos, open_pos + len_begin, TokenMatch.OPEN))
+            open_pos = find(token_begin, open_pos + step_begin, end)
+        tokens.append((close_pos, close_pos + len_end, TokenMatch.CLOSE))
+        close_pos = find(token_end, close_pos + step_end, end)
+    while open_pos != -1:
+        tokens.append((open_pos, open_pos + len_begin, TokenMatch.OPEN))
+        open_pos = find(token_begin, open_pos + step_begin, end)
+    return tokens
+
+
+class TokenList:
+    """A list of non-overlapping tokens (start, end, value) sorted by position.
+
+    Tokens are stored in three parallel lists. Positions of tokens before
+    index _pivot are exact, the others are stored without _delta,
+    an offset that applies to all of them. This makes shifting every
+    token after an edit a single addition.
+
+    replace() moves the pivot to the edited position (which costs the
+    number of tokens it moves past) and removes the covered tokens with
+    a single splice. A sequence of edits moving left to right, as the parser
+    does, thus costs O(log n) per edit (amortized)."""
+
+    _starts: List[int]
+    _ends: List[int]
+    _values: List[Any]
+    _pivot: int
+    _delta: int
+
+    def __init__(
+        self: "TokenList", tokens: Iterable[Tuple[int, int, Any]] = ()
+    ) -> None:
+        """initializes the list, tokens should be sorted by position"""
+        self._starts = []
+        self._ends = []
+        self._values = []
+        for start, end, value in tokens:
+            self._starts.append(start)
+            self._ends.append(end)
+            self._values.append(value)
+        self._pivot = 0
+        self._delta = 0
+
+    def __len__(self: "TokenList") -> int:
+        return len(self._starts)
+
+    def __getitem__(self: "TokenList", index: int) -> Tuple[int, int, Any]:
+        """returns the token (start, end, value) with its current position"""
+        if index < 0:
+            index += len(self._starts)
+        if index < self._pivot:
+            return self._starts[index], self._ends[index], self._values[index]
+        return (
+            self._starts[index] + self._delta,
+            self._ends[index] + self._delta,
+            self._values[index],
+        )
+
+    def __repr__(self: "TokenList") -> str:
+        return "TokenList({})".format([self[i] for i in range(len(self))])
+
+    def _move_pivot(self: "TokenList", index: int) -> None:
+        """moves the pivot to index, updating the stored positions in between"""
+        starts = self._starts
+        ends = self._ends
+        delta = self._delta
+        if index < self._pivot:
+            delta = -delta
+            for i in range(index, self._pivot):
+                starts[i] += delta
+                ends[i] += delta
+        else:
+            for i in range(self._pivot, index):
+                starts[i] += delta
+                ends[i] += delta
+        self._pivot = index
+
+    def bisect(self: "TokenList", position: int) -> int:
+        """returns the index of the first token starting at or after position"""
+        pivot = self._pivot
+        if pivot > 0 and self._starts[pivot - 1] >= position:
+            return bisect_left(self._starts, position, 0, pivot)
+        return bisect_left(
+            self._starts, position - self._delta, pivot, len(self._starts)
+        )
+
+    def replace(self: "TokenList", start: int, end: int, dilatation: int) -> None:
+        """updates tokens when text[start:end] is replaced by
+        a text of length end - start + dilatation:
+        - removes all tokens starting or ending in [start, end[
+        - shifts all tokens starting after end by dilatation"""
+        last = self.bisect(end)
+        self._move_pivot(last)
+        first = bisect_left(self._starts, start, 0, last)
+        while first > 0 and start <= self._ends[first - 1] < end:
+            first -= 1
+        if first != last:
+            del self._starts[first:last]
+            del self._ends[first:last]
+            del self._values[first:last]
+            self._pivot = first
+        self._delta += dilatation
+
+
+class BlockIndex:
+    """Index of the startblock and endblock tags of a block in a text.
+
+    Built once with a single pass over the text, it answers
+    find_endblock() queries (the first unmatched endblock tag after a position)
+    with a binary search. It stays valid while the text is only edited
+    before the queried positions, as the parser does.
+
+    Tags are found like successive calls to re.search would:
+    from the current position, the first tag found is used (an endblock
+    tag if both match at the same place) and the search resumes after it."""
+
+    _positions: List[int]
+    _ends: List[int]
+    _matches: List[Optional[int]]
+    _length: int
+
+    def __init__(
+        self: "BlockIndex",
+        text: str,
+        token_begin: str,
+        startblock_regex: Pattern[str],
+        endblock_regex: Pattern[str],
+    ) -> None:
+        """indexes text. Both regexes should start with token_begin"""
+        self._positions = []
+        self._ends = []
+        self._length = len(text)
+        is_end: List[bool] = []
+        find = text.find
+        pos = find(token_begin)
+        while pos != -1:
+            end_match = endblock_regex.match(text, pos)
+            if end_match is not None:
+                self._positions.append(pos)
+                self._ends.append(end_match.end())
+                is_end.append(True)
+            else:
+                start_match = startblock_regex.match(text, pos)
+                if start_match is not None:
+                    self._positions.append(pos)
+                    self._ends.append(start_match.end())
+                    is_end.append(False)
+            pos = find(token_begin, pos + 1)
+        # _matches[i] is the index of the first unmatched endblock tag
+        # found when searching from tag i (None if there is none)
+        nb_tags = len(self._positions)
+        self._matches = [None] * nb_tags
+        for i in range(nb_tags - 1, -1, -1):
+            if is_end[i]:
+                self._matches[i] = i
+                continue
+            # skip to the endblock tag closing this one, then search after it
+            following = self._next(self._ends[i])
+            if following is None:
+                continue
+            closing = self._matches[following]
+            if closing is None:
+                continue
+            following = self._next(self._ends[closing])
+            if following is not None:
+                self._matches[i] = self._matches[following]
+
+    def _next(self: "BlockIndex", position: int) -> Optional[int]:
+        """index of the first tag at or after position"""
+        index = bisect_left(self._positions, position)
+        if index == len(self._positions):
+            return None
+        return index
+
+    def find_endblock(
+        self: "BlockIndex", position: int, length: int
+    ) -> Tuple[int, int]:
+        """Finds the first endblock tag after position that does not
+        match a startblock tag.
+        Inputs:
+                position: int - where to start searching, in the current text
+                length: int - length of the current text. Only text before
+                        position can have been edited since indexing
+        Returns:
+                tuple(endblock_start_pos: int, endblock_end_pos: int)
+                positions are relative to position
+                (-1,-1) if no such endblock exists"""
+        original = position - length + self._length
+        index = self._next(original)
+        if index is None:
+            return -1, -1
+        match = self._matches[index]
+        if match is None:
+            return -1, -1
+        return self._positions[match] - original, self._ends[match] - original
+
+    def to_lists(self: "BlockIndex") -> Tuple[int, List[int], List[int], List[int]]:
+        """returns (length, positions, ends, matches) to save the index,
+        unmatched tags have match -1"""
+        matches = [-1 if match is None else match for match in self._matches]
+        return self._length, self._positions, self._ends, matches
+
+    @classmethod
+    def from_lists(
+        cls,
+        length: int,
+        positions: List[int],
+        ends: List[int],
+        matches: List[int],
+    ) -> "BlockIndex":
+        """rebuilds an index saved with to_lists"""
+        index = cls.__new__(cls)
+        index._length = length
+        index._positions = positions
+        index._ends = ends
+        index._matches = [None if match == -1 else match for match in matches]
+        return index
@@ -0,0 +1,217 @@
+"""This module implements file change detection for the --watch option
+
+It contains:
+
+- class Watcher
+    the interface: watch(paths) sets the files to watch,
+    wait(timeout) blocks until some of them change and returns them
+
+- class PollingWatcher
+    compares modification times and sizes at a regular interval
+
+- class InotifyWatcher
+    uses the linux inotify API (through ctypes) on the files' directories
+
+- function make_watcher
+    returns an InotifyWatcher when available, a PollingWatcher otherwise
+"""
+import ctypes
+import os
+import select
+import struct
+import sys
+import time
+from os.path import dirname, join
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+# inotify event masks, see "man inotify"
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+)
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class Watcher:
+    """Abstract class of file watchers
+    paths should be absolute"""
+
+    paths: Set[str]
+    # changes closer than this (in seconds) are reported together
+    settle_time: float = 0.05
+
+    def __init__(self: "Watcher") -> None:
+        self.paths = set()
+
+    def watch(self: "Watcher", paths: Iterable[str]) -> None:
+        """sets the files to watch, changes are detected from this call on"""
+        self.paths = set(paths)
+
+    def wait(self: "Watcher", timeout: Optional[float] = None) -> Set[str]:
+        """blocks until a watched file is created, modified or deleted
+        returns the set of changed files (empty if timeout seconds elapsed)"""
+        raise ValueError("Overwrite wait in subclasses")
+
+    def close(self: "Watcher") -> None:
+        """frees the resources used by the watcher"""
+
+
+class PollingWatcher(Watcher):
+    """Watches files by checking their modification time and size
+    every interval seconds"""
+
+    interval: float
+    _signatures: Dict[str, Optional[Tuple[int, int]]]
+
+    def __init__(self: "PollingWatcher", interval: float = 0.5) -> None:
+        super().__init__()
+        self.interval = interval
+        self._signatures = dict()
+
+    @staticmethod
+    def signature(path: str) -> Optional[Tuple[int, int]]:
+        """returns (mtime, size) of the file, None if it doesn't exist"""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def watch(self: "PollingWatcher", paths: Iterable[str]) -> None:
+        # keep the signatures of files already watched,
+        # so changes made since the last wait() aren't lost
+        super().watch(paths)
+        previous = self._signatures
+        self._signatures = dict()
+        for path in self.paths:
+            if path in previous:
+                self._signatures[path] = previous[path]
+            else:
+                self._signatures[path] = self.signature(path)
+
+    def wait(self: "PollingWatcher", timeout: Optional[float] = None) -> Set[str]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            changed = set()
+            for path, signature in self._signatures.items():
+                new_signature = self.signature(path)
+                if new_signature != signature:
+                    self._signatures[path] = new_signature
+                    changed.add(path)
+            if changed:
+                return changed
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return changed
+                time.sleep(min(self.interval, remaining))
+            else:
+                time.sleep(self.interval)
+
+
+class InotifyWatcher(Watcher):
+    """Watches files with inotify (linux only).
+    The directories containing the files are watched, not the files themselves,
+    so that files replaced by editors (written elsewhere and moved in place)
+    are still detected.
+    Raises OSError if inotify is not available"""
+
+    _fd: int
+    _libc: ctypes.CDLL
+    _directories: Dict[str, int]
+    _watch_descriptors: Dict[int, str]
+
+    def __init__(self: "InotifyWatcher") -> None:
+        super().__init__()
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on linux")
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._directories = dict()
+        self._watch_descriptors = dict()
+
+    def watch(self: "InotifyWatcher", paths: Iterable[str]) -> None:
+        super().watch(paths)
+        directories = {dirname(path) for path in self.paths}
+        for directory in list(self._directories):
+            if directory not in directories:
+                wd = self._directories.pop(directory)
+                del self._watch_descriptors[wd]
+                self._libc.inotify_rm_watch(self._fd, wd)
+        for directory in directories:
+            if directory in self._directories:
+                continue
+            wd = self._libc.inotify_add_watch(
+                self._fd, os.fsencode(directory), WATCH_MASK
+            )
+            if wd >= 0:  # missing directories can't be watched
+                self._directories[directory] = wd
+                self._watch_descriptors[wd] = directory
+
+    def _read_events(self: "InotifyWatcher") -> Set[str]:
+        """reads pending events, returns the watched paths they concern"""
+        changed: Set[str] = set()
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                return changed
+            pos = 0
+            while pos + EVENT_HEADER.size <= len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, pos)
+                pos += EVENT_HEADER.size
+                name = os.fsdecode(data[pos : pos + length].rstrip(b"\0"))
+                pos += length
+                if mask & IN_Q_OVERFLOW:
+                    changed.update(self.paths)
+                elif wd in self._watch_descriptors:
+                    path = join(self._watch_descriptors[wd], name)
+                    if path in self.paths:
+                        changed.add(path)
+
+    def wait(self: "InotifyWatcher", timeout: Optional[float] = None) -> Set[str]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - time.monotonic(), 0)
+            ready, _, _ = select.select([self._fd], [], [], remaining)
+            if not ready:
+                return set()
+            changed = self._read_events()
+            if changed:
+                # let writes finish, and group related changes
+                time.sleep(self.settle_time)
+                changed.update(self._read_events())
+                return changed
+
+    def close(self: "InotifyWatcher") -> None:
+        os.close(self._fd)
+
+
+def make_watcher(interval: float = 0.5) -> Watcher:
+    """returns an InotifyWatcher if possible,
+    a PollingWatcher checking every interval seconds otherwise"""
+    try:
+        return InotifyWatcher()
+    except (OSError, AttributeError):
+        # AttributeError: libc doesn't have inotify functions
+        return PollingWatcher(interval)
@@ -1,9 +1,30 @@
-from os import remove
-from typing import List, Tuple
+import sys
+from argparse import ArgumentError, Namespace
+from contextlib import redirect_stderr
+from io import StringIO
+from os import chmod, listdir, mkdir, remove, stat, symlink
+from os.path import join
+from tempfile import TemporaryDirectory
+from typing import Any, Dict, List, Optional, Tuple
 
+import mlpproc.__main__
 from mlpproc import Preprocessor
-from mlpproc.blocks import Blck_If
-from mlpproc.errors import WarningMode
+from mlpproc.__main__ import preprocessor_main, run_worker
+from mlpproc.blocks import Blck_Cut, Blck_If
+from mlpproc.cache import CachedResult, DiskCache, ResultCache
+from mlpproc.commands import Cmd_Def, Cmd_Include, Constant, macro_parser
+from mlpproc.defs import (
+    ArgumentBinder,
+    ArgumentParserNoExit,
+    parse_defines,
+    read_define_file,
+)
+from mlpproc.errors import PreprocessorError, WarningMode
+from mlpproc.files import FileCache, dependency_rule, write_if_changed, write_spliced
+from mlpproc.final_actions import Cmd_Replace
+from mlpproc.memo import IncludeMemo
+from mlpproc.preprocessor import Command
+from mlpproc.watch import InotifyWatcher, PollingWatcher, Watcher
 
 
 class TestCommands:
@@ -65,9 +86,109 @@ class TestCommands:
                 "{% def f(a,b) a+b %}{% def f(a) {% f a 0 %} %}{% f 1 2 %}; {% f 1 %}",
                 "1+2; 1+0",
             ),
+            ("{% def f(a,b) <b a b> %}{% f x\\1 y %}", "<y x\\1 y>"),
+            (
+                "{% def f(a,b,c,d,e,f,g,h,i,j,k) k-a %}{% f 1 2 3 4 5 6 7 8 9 10 11 %}",
+                "11-1",
+            ),
         ]
         self.runtests(test, "test_def")
 
+    def test_macro_expansion(self) -> None:
+        test = [
+            # arguments are inserted as is
+            ("{% def f(a) <a> %}{% f x\\ny\\\\z\\1 %}", "<x\\ny\\\\z\\1>"),
+            ('{% def f(a) <a> %}{% f "x\\ny" %}', "<x\ny>"),
+            (
+                "{% def f(a0,a1,a2,a3,a4,a5,a6,a7,a8,a9,a10,a11) a11 a10 a1 a0 %}"
+                "{% f 0 1 2 3 4 5 6 7 8 9 10 11 %}",
+                "11 10 1 0",
+            ),
+        ]
+        self.runtests(test, "test_macro_expansion")
+        # bodies without tokens aren't parsed: no new context or recursion level
+        pre = Preprocessor()
+        pre.max_recursion_depth = 2
+        descriptions: List[Optional[str]] = []
+        update = pre.context.update
+
+        def record(pos: int, desc: Optional[str] = None) -> None:
+            descriptions.append(desc)
+            update(pos, desc)
+
+        setattr(pre.context, "update", record)
+        source = "{% def f(a,b) (a b) %}{% f x y %}"
+        assert pre.process(source, "test_macro_expansion") == "(x y)"
+        assert "in expansion of defined command f" not in descriptions
+        # while bodies with tokens are
+        Cmd_Def.define_macro(pre, "g", [], "{% version %}")
+        try:
+            pre.process("{% g %}", "test_macro_expansion")
+            assert False
+        except PreprocessorError as error:
+            assert error.name == "recursion-depth"
+
+    def test_macro_overloads(self) -> None:
+        preprocessor = Preprocessor()
+        source = "".join(
+            "{{% def m{0}(a) {0}-a %}}{{% m{0} {0} %}}".format(i) for i in range(2000)
+        )
+        expected = "".join("{0}-{0}".format(i) for i in range(2000))
+        assert preprocessor.process(source, "test_macro_overloads") == expected
+        assert len(preprocessor.command_vars["def"]) == 2000
+        preprocessor.process("{% def f(a) a %}{% def f(a,b) a %}", "test")
+        assert preprocessor.commands["f"].doc == (
+            "Defined command for f (expects 1 or 2 arguments)\nusage: f a\n       f a b"
+        )
+        try:
+            preprocessor.process("{% f %}", "test_macro_overloads")
+            assert False
+        except PreprocessorError:
+            pass
+
+    def test_define_file(self) -> None:
+        with TemporaryDirectory() as directory:
+            env = join(directory, "defines.env")
+            with open(env, "w") as file:
+                file.write(
+                    "# comment\nexport a=1\nb = \" x\\n \"\nc='y\\n'\nd\ne={% a %}+a\n"
+                )
+            defines = read_define_file(env)
+            assert defines == {
+                "a": "1",
+                "b": " x\n ",
+                "c": "y\\n",
+                "d": "",
+                "e": "{% a %}+a",
+            }
+            data = join(directory, "defines.json")
+            with open(data, "w") as file:
+                file.write('{"f": 2, "g": null, "h": "{% b %}"}')
+            pre = Preprocessor()
+            Cmd_Def.define_constants(pre, defines)
+            Cmd_Def.define_constants(pre, read_define_file(data))
+            assert isinstance(pre.commands["a"], Constant)
+            try:
+                Cmd_Def.define_constants(pre, {"é": "3"})
+                assert False
+            except ValueError:
+                pass
+            result = pre.process(
+                "{% a %}{% b %}{% d %}{% e %}{% f %}{% g %}{% h %}", "test"
+            )
+            assert result == "1 x\n 1+a2 x\n "
+            for text in ("1a=b", "a b=c", "é=3"):
+                try:
+                    parse_defines(text)
+                    assert False
+                except ValueError:
+                    pass
+            try:
+                pre.process("{% a b %}", "test_define_file")
+                assert False
+            except PreprocessorError:
+                pass
+
     def test_begin_end(self) -> None:
         test = [
             ("{% begin %}", "{%"),
@@ -351,3 +472,484 @@ class TestCommands:
             ),
         ]
         self.runtests(test, "test_if")
+
+    def test_render(self) -> None:
+        source = (
+            "{% if def foo %}foo={% foo %}{% for i in 1 2 %} {% i %}{% endfor %}"
+            "{% else %}no foo{% endif %}\n{% line %}"
+        )
+        template = Preprocessor().compile(source, "test_render")
+        for define in ["", "bar", "baz", None]:
+            pre = Preprocessor()
+            if define is not None:
+                pre.process("{% def foo " + define + " %}", "test_render")
+            expected = pre.process(source, "test_render")
+            assert pre.render(template) == expected
+
+    def test_disk_cache(self) -> None:
+        path = "test.out"
+        with open(path, "w") as file:
+            file.write("{% for i in 1 2 %}{% i %}{% endfor %}")
+        source = "{% if def foo %}{% include test.out %}{% else %}no{% endif %}"
+        with TemporaryDirectory() as directory:
+            cache = DiskCache(directory)
+            for define in ["", "bar", None, "bar"]:
+                pre = Preprocessor()
+                pre.disk_cache = cache
+                if define is not None:
+                    pre.process("{% def foo " + define + " %}", "test_disk_cache")
+                expected = pre.process(source, "test_disk_cache")
+                assert pre.render(pre.compile(source, "test_disk_cache")) == expected
+            stats = cache.check()
+            assert stats.entries == 2
+            assert stats.removed == 0
+            assert cache.clean() == 2
+            assert cache.size() == 0
+        remove(path)
+
+    def test_batch(self) -> None:
+        with TemporaryDirectory() as directory:
+            inputs = []
+            for i in range(3):
+                inputs.append(join(directory, "in{}.txt".format(i)))
+                with open(inputs[-1], "w") as file:
+                    file.write("{% def a " + str(i) + " %}{% include inc.txt %}{% a %}")
+            include = join(directory, "inc.txt")
+            output_dir = join(directory, "out")
+            for content, jobs in [("x{% a %}", "1"), ("y{% a %}", "2")]:
+                with open(include, "w") as file:
+                    file.write(content)
+                preprocessor_main(inputs + ["-O", output_dir, "-j", jobs])
+                for i in range(3):
+                    with open(join(output_dir, "in{}.txt".format(i))) as file:
+                        assert file.read() == content[0] + 2 * str(i)
+
+    def test_batch_errors(self) -> None:
+        with TemporaryDirectory() as directory:
+            inputs = []
+            for i, text in enumerate(
+                ["{% warning w0 %}", "{% error e1 %}", "{% warning w2 %}"]
+            ):
+                inputs.append(join(directory, "in{}.txt".format(i)))
+                with open(inputs[-1], "w") as file:
+                    file.write(text)
+            # the first error stops the run, messages are printed in input order
+            err = StringIO()
+            try:
+                with redirect_stderr(err):
+                    preprocessor_main(
+                        inputs + ["-O", join(directory, "out"), "-j", "2"]
+                    )
+                assert False
+            except SystemExit as error:
+                assert error.code == Preprocessor.exit_code
+            messages = err.getvalue()
+            assert "w0" in messages and "e1" in messages and "w2" not in messages
+            assert messages.index("w0") < messages.index("e1")
+
+            # --shared-includes has no effect on a single process
+            try:
+                with redirect_stderr(StringIO()):
+                    preprocessor_main(inputs + ["-O", directory, "--shared-includes"])
+                assert False
+            except SystemExit as error:
+                assert error.code == 2
+
+        # exit messages are printed like the interpreter does
+        def exit_with_message(*_: Any) -> None:
+            sys.exit("stopped")
+
+        run_document = mlpproc.__main__.run_document
+        try:
+            setattr(mlpproc.__main__, "run_document", exit_with_message)
+            args = Namespace(shared_files=None, shared_maxsize=None)
+            assert run_worker(args) == ("", "stopped\n", 1)
+        finally:
+            setattr(mlpproc.__main__, "run_document", run_document)
+
+    def test_watchers(self) -> None:
+        watchers: List[Watcher] = [PollingWatcher(0.01)]
+        try:
+            watchers.append(InotifyWatcher())
+        except (OSError, AttributeError):
+            pass
+        for watcher in watchers:
+            with TemporaryDirectory() as directory:
+                path = join(directory, "watched")
+                other = join(directory, "other")
+                with open(path, "w") as file:
+                    file.write("a")
+                watcher.watch([path])
+                assert watcher.wait(0.05) == set()
+                with open(other, "w") as file:
+                    file.write("b")
+                with open(path, "w") as file:
+                    file.write("bc")
+                assert watcher.wait(1) == {path}
+                remove(path)
+                assert watcher.wait(1) == {path}
+            watcher.close()
+
+    def test_file_cache(self) -> None:
+        with TemporaryDirectory() as directory:
+            paths = [join(directory, name) for name in "abc"]
+            for path in paths:
+                with open(path, "w") as file:
+                    file.write("0123")
+            shared: Dict[str, Tuple[Tuple[int, int], str]] = dict()
+            cache = FileCache(maxsize=10, shared=shared)
+            for path in paths + paths[1:]:
+                assert cache.read(path) == "0123"
+            info = cache.cache_info()
+            assert (info.hits, info.misses, info.evictions) == (2, 3, 1)
+            assert info.currsize == 8
+            # a is no longer cached locally, but is in the shared cache
+            assert FileCache(shared=shared).read(paths[0]) == "0123"
+            assert cache.read(paths[0]) == "0123"
+            assert cache.cache_info().hits == 3
+            with open(paths[0], "w") as file:
+                file.write("01234")
+            assert cache.read(paths[0]) == "01234"
+            assert cache.cache_info().misses == 4
+            # the shared mapping is bounded too
+            shared.clear()
+            cache = FileCache(shared=shared, shared_maxsize=8)
+            for path in paths:
+                cache.read(path)
+            assert sorted(shared) == paths[1:]
+
+    def test_argument_binder(self) -> None:
+        tests: List[Tuple[ArgumentParserNoExit, List[str], bool]] = [
+            (Cmd_Include.parser, ["-v", "path"], True),
+            (Cmd_Include.parser, ["path", "-b", "<", "-e"], True),
+            (Cmd_Include.parser, ["--verb", "path"], False),  # prefix
+            (Cmd_Include.parser, ["--begin=<", "path"], False),
+            (Cmd_Replace.parser, ["-c", "2", "foo", "bar", "-w"], True),
+            (Cmd_Replace.parser, ["foo", "-w", "bar"], False),  # split positionals
+            (Cmd_Replace.parser, ["-c", "x", "foo", "bar"], False),  # invalid int
+            (Cmd_Replace.parser, ["foo"], False),  # missing argument
+            (Blck_Cut.parser, ["-p"], True),
+            (macro_parser, ["a", "", "b c"], True),
+            (macro_parser, [], True),
+            (macro_parser, ["-1", "--", "-x"], False),
+        ]
+        for parser, args, bound in tests:
+            values = ArgumentBinder(parser._actions).bind(args)
+            assert (values is not None) == bound
+            try:
+                expected = vars(parser.parse_args(args))
+            except ArgumentError:
+                continue
+            assert vars(parser.bind(args)) == expected
+            if values is not None:
+                assert values == expected
+
+    def test_prefetch(self) -> None:
+        pre = Preprocessor()
+        source = "{% include a %}{% include -b < -e > -o b %}{% include\n-v c %}"
+        source += '{% include "d" %}{% include {% e %} %}{% include f g %}'
+        assert pre.literal_includes(source) == ["a", "b", "c"]
+        with TemporaryDirectory() as directory:
+            sub = join(directory, "sub")
+            mkdir(sub)
+            with open(join(sub, "a"), "w") as file:
+                file.write("a{% include b %}")
+            with open(join(sub, "b"), "w") as file:
+                file.write("b")
+            pre.include_path = [directory]
+            pre.prefetch_includes = True
+            assert pre.file_cache is not None
+            source = "{% include sub/a %}{% include sub/a %}{% include missing %}"
+            try:
+                pre.process(source, "test_prefetch")
+                assert False
+            except PreprocessorError as error:
+                assert error.name == "file-error"
+            pre.file_cache.close()
+            # sub/a and b (prefetched while loading sub/a) were never read by include
+            assert pre.file_cache.cache_info().misses == 0
+            # pending prefetches are bounded
+            cache = FileCache(max_prefetches=1)
+            cache.prefetch(["a", "b"], [sub])
+            assert len(cache._pending) == 1
+            assert cache.resolve("a", [sub]) == join(sub, "a")
+            cache.prefetch(["b"], [sub])
+            assert cache.resolve("b", [sub]) == join(sub, "b")
+            assert cache.cache_info().currsize == len("a{% include b %}b")
+            cache.close()
+
+    def test_include_path(self) -> None:
+        with TemporaryDirectory() as directory:
+            sub = join(directory, "sub")
+            mkdir(sub)
+            for path, content in [
+                (join(directory, "a"), "{% include sub/b %}{% include b %}"),
+                (join(sub, "b"), "b{% include c %}"),
+                (join(sub, "c"), "c"),
+            ]:
+                with open(path, "w") as file:
+                    file.write(content)
+            pre = Preprocessor()
+            pre.include_path = [directory]
+            pre.warning_mode = WarningMode.HIDE
+            # b is only found in sub while including a file from sub
+            try:
+                pre.process("{% include a %}", "test_include_path")
+                assert False
+            except PreprocessorError:
+                pass
+            assert pre.include_path == [directory]
+            pre = Preprocessor()
+            pre.include_path = [directory, sub]
+            assert pre.process("{% include a %}", "test_include_path") == "bcbc"
+            assert pre.include_path == [directory, sub]
+            assert pre.file_cache is not None
+            assert pre.file_cache.resolve("d", [sub]) is None
+            with open(join(sub, "d"), "w") as file:
+                file.write("d")
+            assert pre.file_cache.resolve("d", [sub]) is None
+            pre.file_cache.forget(join(sub, "d"))
+            assert pre.file_cache.resolve("d", [sub]) == join(sub, "d")
+            with open(join(sub, "e"), "w") as file:
+                file.write("{% error %}")
+            assert pre.file_cache.resolve("f", [sub]) is None
+            with open(join(sub, "f"), "w") as file:
+                file.write("f")
+            pre.file_cache.forget_resolutions()
+            assert pre.file_cache.resolve("f", [sub]) == join(sub, "f")
+            # the directory of a file is removed from the path after errors
+            pre.include_path = [directory]
+            try:
+                pre.process("{% include sub/e %}", "test_include_path")
+                assert False
+            except PreprocessorError:
+                pass
+            assert pre.include_path == [directory]
+
+    def test_include_once(self) -> None:
+        with TemporaryDirectory() as directory:
+            path = join(directory, "a")
+            with open(path, "w") as file:
+                file.write("a")
+            symlink(path, join(directory, "b"))
+
+            def run(
+                source: str, name: str = "test_include_once", once: bool = False
+            ) -> str:
+                pre = Preprocessor()
+                pre.include_path = [directory]
+                pre.include_once = once
+                return pre.process(source, name)
+
+            source = "{% include a %}{% include --once b %}{% include -o -v a %}"
+            assert run(source) == "a"
+            assert run("{% include a %}" * 2) == "aa"
+            assert run("{% include a %}" * 2, once=True) == "a"
+            # each document or render starts with no file included
+            pre = Preprocessor()
+            pre.include_path = [directory]
+            pre.include_once = True
+            template = pre.compile("{% include a %}" * 2, "test_include_once")
+            assert pre.render(template) == "a"
+            assert pre.render(template) == "a"
+            assert pre.process("{% include a %}", "test_include_once") == "a"
+            with open(path, "w") as file:
+                file.write("{% include b %}")
+            try:
+                run("{% include a %}")
+                assert False
+            except PreprocessorError as error:
+                assert error.name == "include-cycle"
+                assert "a\n  includes b" in error.message
+            # the stack is unwound after errors
+            with open(path, "w") as file:
+                file.write("{% error %}")
+            pre = Preprocessor()
+            pre.include_path = [directory]
+            for _ in range(2):
+                try:
+                    pre.process("{% include a %}", "test_include_once")
+                    assert False
+                except PreprocessorError as error:
+                    assert error.name == "manual-error"
+            # including the main document
+            main = join(directory, "main")
+            with open(main, "w") as file:
+                file.write("{% include a %}")
+            with open(path, "w") as file:
+                file.write("{% include main %}")
+            try:
+                run("{% include a %}", main)
+                assert False
+            except PreprocessorError as error:
+                assert error.name == "include-cycle"
+
+    def test_include_memo(self) -> None:
+        with TemporaryDirectory() as directory:
+            path = join(directory, "a")
+            with open(path, "w") as file:
+                file.write("{% x %}{% include b %}")
+            with open(join(directory, "b"), "w") as file:
+                file.write("b")
+            pre = Preprocessor()
+            pre.include_path = [directory]
+            # memoization is opt-in, other commands may have side effects
+            count = [0]
+
+            class Cmd_Count(Command):
+                def __call__(self, _: Preprocessor, args: str) -> str:
+                    count[0] += 1
+                    return str(count[0])
+
+            pre.commands["count"] = Cmd_Count()
+            with open(join(directory, "c"), "w") as file:
+                file.write("[{% count %}]")
+            assert pre.process("{% include c %}" * 2, "test") == "[1][2]"
+            pre.include_memo = IncludeMemo()
+            source = "{% def x 1 %}{% include a %}{% include a %}"
+            source += "{% def x 2 %}{% include a %}{% include a %}"
+            assert pre.process(source, "test_include_memo") == "1b1b2b2b"
+            assert pre.include_memo.hits == 3  # a twice, b once (in a)
+            # nested files are checked
+            with open(join(directory, "b"), "w") as file:
+                file.write("bb")
+            assert pre.process("{% def x 2 %}" + "{% include a %}" * 2, "t") == "2bb2bb"
+            assert pre.include_memo.hits == 4
+            # files with side effects are rendered each time
+            with open(path, "w") as file:
+                file.write("{% def y %}{% label l %}{% paste %}")
+            pre.include_memo.hits = 0
+            source = "{% cut %}c{% endcut %}{% include a %}{% include a %}"
+            assert pre.process(source, "test_include_memo") == "cc"
+            assert pre.include_memo.hits == 0
+            # definitions and clipboards are tracked by generation
+            for text in ("{% def y %}", "{% cut %}c{% endcut %}", "{% deflist z a %}"):
+                with open(path, "w") as file:
+                    file.write(text)
+                generation = pre.generation
+                pre.process("{% include a %}{% include a %}", "test_include_memo")
+                assert pre.generation == generation + 2
+            assert pre.include_memo.hits == 0
+
+    def test_deferred_include(self) -> None:
+        with TemporaryDirectory() as directory:
+            path = join(directory, "a")
+            with open(path, "w") as file:
+                file.write("é{% x %}\n" * 1000)
+            pre = Preprocessor()
+            pre.include_path = [directory]
+            pre.defer_verbatim = True
+            source = "{% label l %}<{% include -v a %}>{% atlabel l %}{% upper a %}"
+            source += "{% endatlabel %}{% upper {% include -v a %} %}"
+            result = pre.process(source, "test_deferred_include")
+            parts = pre.split_deferred(result)
+            assert parts[0] == "A<" and parts[1] == path
+            assert parts[2].startswith(">É{% X %}")
+            output = join(directory, "output")
+            write_spliced(output, parts)
+            with open(output) as file:
+                text = file.read()
+            expected = "A<" + "é{% x %}\n" * 1000 + ">" + "É{% X %}\n" * 1000
+            assert text == expected.strip()
+            # final actions inspecting the text get the file's contents
+            pre = Preprocessor()
+            pre.include_path = [directory]
+            pre.defer_verbatim = True
+            pre.final_actions.append(lambda _, text: text.replace("\n", ""))
+            result = pre.process(source, "test_deferred_include")
+            assert pre.split_deferred(result) == [text.replace("\n", "")]
+            # only copied as is with --copy-verbatim
+            with open(path, "wb") as file:
+                file.write(b"a\r\nb\r\n")
+            source = join(directory, "source")
+            with open(source, "w") as file:
+                file.write("{% include -v a %}")
+            for options, expected_bytes in (
+                ([], b"a\nb\n"),
+                (["--copy-verbatim"], b"a\r\nb\r\n"),
+            ):
+                preprocessor_main([source, "-o", output] + options)
+                with open(output, "rb") as binary:
+                    assert binary.read() == expected_bytes
+
+    def test_write_if_changed(self) -> None:
+        with TemporaryDirectory() as directory:
+            path = join(directory, "output")
+            assert write_if_changed(path, "hello\n")
+            chmod(path, 0o640)
+            inode = stat(path).st_ino
+            assert not write_if_changed(path, "hello\n")
+            assert stat(path).st_ino == inode
+            for text in ["hellO\n", "hello", "hello\n\n", ""]:
+                assert write_if_changed(path, text)
+                with open(path) as file:
+                    assert file.read() == text
+                assert stat(path).st_mode & 0o777 == 0o640
+            assert listdir(directory) == ["output"]
+
+    def test_dependencies(self) -> None:
+        path = "test.out"
+        with open(path, "w") as file:
+            file.write("hello")
+        pre = Preprocessor()
+        pre.process(
+            "{% include test.out %}{% filesize test.out %}{% include -v test.out %}",
+            "test_dependencies",
+        )
+        assert pre.dependencies == [path]
+        remove(path)
+        rule = dependency_rule("out put", ["in", "a$b", "c#"], True)
+        assert rule == "out\\ put: \\\n  in \\\n  a$$b \\\n  c\\#\n\na$$b:\n\nc\\#:\n"
+
+    def test_result_cache(self) -> None:
+        with TemporaryDirectory() as directory:
+            path = join(directory, "dependency")
+            with open(path, "w") as file:
+                file.write("a")
+            result = CachedResult("output", "warning", [path])
+            results = ResultCache(DiskCache(directory))
+            assert results.get("key") is None
+            results.put("key", result)
+            assert results.get("key") == result
+            assert ResultCache(results.cache).get("key") == result
+            with open(path, "w") as file:
+                file.write("b")
+            assert ResultCache(results.cache).get("key") is None
+            # a file created in the include path shadows the one found
+            first = join(directory, "first")
+            second = join(directory, "second")
+            mkdir(first)
+            mkdir(second)
+            with open(join(second, "x"), "w") as file:
+                file.write("two")
+            source = join(directory, "source")
+            with open(source, "w") as file:
+                file.write("{% include x %}")
+            output = join(directory, "output")
+            options = ["-I", first, "-I", second, "--cache-dir", join(directory, "c")]
+            for expected in ("two", "two", "one"):
+                if expected == "one":
+                    with open(join(first, "x"), "w") as file:
+                        file.write("one")
+                preprocessor_main([source, "-o", output] + options)
+                with open(output) as file:
+                    assert file.read() == expected
+        pre = Preprocessor()
+        pre.process("{% date %}", "test_result_cache")
+        assert pre.volatile
+
+    def test_process_stream(self) -> None:
+        sources = [
+            "a {% def x 3 %}{% x %}\n" * 20 + "{% for i in 1 2 %}{% i %},{% endfor %}",
+            "{% if 0 %}no{% elif 1 %}yes\n{% line %}{% else %}no{% endif %}\n" * 5,
+            "a\n{% label foo %}\n{% line %}\n{% atlabel foo %}b{% endatlabel %}c",
+            "{% def m(x) [x] %}" + "{% m {% m q %} %}\n" * 10,
+        ]
+        for source in sources:
+            expected = Preprocessor().process(source, "test_process_stream")
+            for chunk_size in [1, 3, 1 << 16]:
+                output = StringIO()
+                Preprocessor().process_stream(
+                    StringIO(source), output, "test_process_stream", chunk_size
+                )
+                assert output.getvalue() == expected
@@ -1,5 +1,8 @@
 from mlpproc import FileDescriptor, Preprocessor
+from mlpproc.buffer import TextBuffer
 from mlpproc.defs import TokenMatch, get_identifier_name
+from mlpproc.patterns import PatternKind, PatternRegistry
+from mlpproc.tokens import TokenList
 
 
 def test_context() -> None:
@@ -55,6 +58,10 @@ class TestPreProcMethods:
         ]
         for test_in, test_out in tests:
             assert self.pre._find_tokens(test_in) == test_out
+        assert self.pre._find_tokens("(a)(b)", 1, 5) == [
+            (2, 3, TokenMatch.CLOSE),
+            (3, 4, TokenMatch.OPEN),
+        ]
 
     def test_find_matching_pair(self) -> None:
         """Unit test for Preprovessor.find_matchin_pair"""
@@ -86,6 +93,9 @@ class TestPreProcMethods:
         ]
         for test_in, test_out in tests:
             assert self.pre._find_matching_pair(test_in) == test_out
+        tokens = tests[3][0]
+        assert self.pre._find_matching_pair(tokens, 3) == 4
+        assert self.pre._find_matching_pair(tokens, 5) == -1
 
     def test_find_matching_endblock(self) -> None:
         test = [
@@ -99,6 +109,12 @@ class TestPreProcMethods:
         ]
         for arg0, arg1, rep in test:
             assert self.pre._find_matching_endblock(arg0, arg1) == rep
+        # positions in the text after the prefix was edited
+        index = self.pre._block_index("i", "(i) (i) a (ei) b (ei)")
+        assert index.find_endblock(3, 21) == (14, 18)
+        assert index.find_endblock(1, 19) == (14, 18)
+        assert index.find_endblock(15, 21) == (2, 6)
+        assert index.find_endblock(30, 30) == (-1, -1)
 
     def test_split_args(self) -> None:
         test = [
@@ -117,3 +133,49 @@ class TestPreProcMethods:
         ]
         for arg, rep in test:
             assert self.pre.split_args(arg) == rep
+
+
+def test_text_buffer() -> None:
+    text = "0123456789"
+    buffer = TextBuffer(text)
+    edits = [(2, 4, "ab"), (0, 0, "xyz"), (5, 9, ""), (8, 9, "--"), (1, 7, "+")]
+    for start, end, replacement in edits:
+        buffer.replace(start, end, replacement)
+        text = text[:start] + replacement + text[end:]
+        assert len(buffer) == len(text)
+        for i in range(len(text) + 1):
+            assert buffer[i:] == text[i:]
+            assert buffer[:i] == text[:i]
+    assert str(buffer) == text
+    assert buffer[-1] == text[-1]
+
+
+def test_token_list() -> None:
+    tokens = [(i, i + 2, i) for i in range(0, 40, 3)]
+    token_list = TokenList(tokens)
+    edits = [(4, 7, 5), (0, 1, 0), (20, 26, -4), (3, 3, 2), (10, 40, -20), (1, 2, 1)]
+    for start, end, dilat in edits:
+        token_list.replace(start, end, dilat)
+        test_range = range(start, end)
+        tokens = [
+            (x + dilat, y + dilat, v) if x >= end else (x, y, v)
+            for x, y, v in tokens
+            if x not in test_range and y not in test_range
+        ]
+        assert len(token_list) == len(tokens)
+        assert [token_list[i] for i in range(len(tokens))] == tokens
+
+
+def test_pattern_registry() -> None:
+    registry = PatternRegistry(maxsize=2)
+    begin = registry.get(PatternKind.STARTBLOCK, "{%", "%}", name="if")
+    assert begin.match("{% if x") is not None
+    assert registry.get(PatternKind.STARTBLOCK, "{%", "%}", name="if") is begin
+    registry.get(PatternKind.ENDBLOCK, "{%", "%}", "end", "if")
+    registry.get(PatternKind.REGEX, name="a+")
+    assert registry.cache_info() == (1, 3, 2, 2)
+    # least recently used pattern was evicted
+    registry.get(PatternKind.STARTBLOCK, "{%", "%}", name="if")
+    assert registry.cache_info() == (1, 4, 2, 2)
+    registry.clear()
+    assert registry.cache_info() == (0, 0, 2, 0)